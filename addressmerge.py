@@ -4,35 +4,623 @@
 # Basic modules
 import logging as l
 l.basicConfig(level=l.DEBUG)
-from collections import deque
+from array import array
+import contextlib
 import copy
+import io
+import bz2
+import gzip
+import hashlib
+import math
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 # Database modules
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 
 # .osm modules
-# This imports the single-threaded XML parser from imposm.
-# This is more reliable with strangely formatted but valid XML
-# and the speed differences don't matter for small files
-from imposm.parser.xml.parser import XMLParser as OSMParser
-from lxml import etree
+# The single-threaded XML parser from imposm is more reliable with strangely
+# formatted but valid XML, so it is used for all XML input. PBF input is read
+# with the multi-process parser, which scales with cores on large files.
+from imposm.parser.xml.parser import XMLParser
+from imposm.parser import OSMParser
+
+try:
+    import numpy
+except ImportError:
+    # numpy is only needed by MemorySource
+    numpy = None
+
+def parse_input(input, nodes_callback, workers=None):
+    '''
+    Parses the nodes of input, choosing a parser from the file extension.
+    .pbf files use the multi-process parser with workers processes (all cores
+    if None), .osm, .osm.bz2 and .osm.gz files use the XML parser.
+    '''
+    if input.endswith('.pbf'):
+        l.debug('Parsing %s as PBF with %s workers', input, workers or 'all')
+        OSMParser(concurrency=workers, nodes_callback=nodes_callback).parse(input)
+        return
+
+    f = _open_input(input)
+    try:
+        l.debug('Parsing %s as XML', input)
+        XMLParser(nodes_callback=nodes_callback).parse(f)
+    finally:
+        f.close()
+
+def _open_input(input):
+    '''
+    Opens an XML input file, decompressing .bz2 and .gz files
+    '''
+    if input.endswith('.bz2'):
+        return bz2.BZ2File(input, 'rb')
+    elif input.endswith('.gz'):
+        return gzip.open(input, 'rb')
+    return open(input, 'rb')
+
+class _ThreadedOutput(object):
+    '''
+    Writes to f from a background thread, so that compressing the output
+    overlaps with serializing it. An error in the thread is raised by the next
+    write or by close.
+    '''
+    def __init__(self, f, queue_size=16):
+        self._f = f
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='compress')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            # Keep draining after an error so write never blocks
+            if self._error is None:
+                try:
+                    self._f.write(data)
+                except BaseException as e:
+                    self._error = e
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(data)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if self._error is not None:
+                raise self._error
+        finally:
+            self._f.close()
+
+class _OsmiumOutput(object):
+    '''
+    Converts the .osm XML written to it with osmium, for formats like PBF
+    '''
+    def __init__(self, output):
+        self.output = output
+        try:
+            self._process = subprocess.Popen(['osmium', 'cat', '-F', 'osm', '-O', '-o', output, '-'],
+                                             stdin=subprocess.PIPE)
+        except OSError as e:
+            raise RuntimeError('osmium is needed to write %s: %s' % (output, e))
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def close(self):
+        self._process.stdin.close()
+        if self._process.wait() != 0:
+            raise RuntimeError('osmium failed to write %s' % self.output)
+
+class _StandardOutput(object):
+    '''
+    Writes bytes to stdout. close only flushes, leaving stdout open.
+    '''
+    def __init__(self):
+        self._f = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    def write(self, data):
+        self._f.write(data)
+
+    def close(self):
+        self._f.flush()
+
+def _open_output(output):
+    '''
+    Opens an output file for writing bytes, choosing from the file extension.
+    .gz and .bz2 files are compressed in a background thread and .pbf files
+    are converted with osmium. - is stdout.
+    '''
+    if output == '-':
+        return _StandardOutput()
+    if output.endswith('.pbf'):
+        return _OsmiumOutput(output)
+    if output.endswith('.bz2'):
+        return _ThreadedOutput(bz2.BZ2File(output, 'wb'))
+    elif output.endswith('.gz'):
+        return _ThreadedOutput(gzip.open(output, 'wb'))
+    return open(output, 'wb')
+
+def _close_outputs(outputs):
+    '''
+    Closes outputs left open by a failed run. Errors are logged instead of
+    raised so they don't hide the error which stopped the run.
+    '''
+    for f in outputs:
+        try:
+            f.close()
+        except Exception as e:
+            l.debug('Error closing output: %s', e)
+
+# Bump when the contents of local_all change so cached areas are rebuilt
+CACHE_VERSION = 4
+
+def _data_state(curs):
+    '''
+    Returns a string which changes whenever the pgsnapshot tables are modified.
+    The highest id of each table is read from the data, so added objects are
+    always seen. Modified and deleted objects are only seen through the
+    statistics collector's counters, so track_counts must be on. A statistics
+    reset also causes cached areas to be rebuilt.
+    '''
+    curs.execute('''SELECT current_setting('track_counts')::boolean;''')
+    if not curs.fetchone()[0]:
+        raise RuntimeError('Cached areas need track_counts to be on to notice changes to the OSM data')
+    # Counters are otherwise read once per transaction, and this may not be the first read
+    curs.execute('''SELECT pg_stat_clear_snapshot();''')
+    curs.execute('''SELECT concat_ws(',',
+                      (SELECT COALESCE(max(id), 0) FROM nodes),
+                      (SELECT COALESCE(max(id), 0) FROM ways),
+                      (SELECT COALESCE(max(id), 0) FROM relations),
+                      (SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()),
+                      (SELECT string_agg(relname || ':' || n_tup_ins || '/' || n_tup_upd || '/' || n_tup_del,
+                                         ',' ORDER BY relname)
+                        FROM pg_stat_user_tables
+                        WHERE relid IN ('nodes'::regclass, 'ways'::regclass,
+                                        'relations'::regclass, 'relation_members'::regclass)));''')
+    return curs.fetchone()[0]
+
+def list_cached_areas(conn):
+    '''
+    Returns (key, wkt, state, created, used, size) for each cached local_all
+    '''
+    curs = None
+    try:
+        curs = conn.cursor()
+        curs.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'addressmerge_cache');''')
+        if not curs.fetchone()[0]:
+            return []
+        curs.execute('''SELECT key, wkt, state, created, used,
+                          (SELECT pg_total_relation_size(c.oid) FROM pg_class c
+                            WHERE c.relname = table_name AND c.relkind = 'r')
+                          FROM addressmerge_cache ORDER BY used DESC;''')
+        return curs.fetchall()
+    finally:
+        if curs is not None:
+            curs.close()
+        conn.rollback()
+
+def evict_cached_areas(conn, key=None):
+    '''
+    Removes the cached areas with keys starting with key, or all of them if key
+    is None, and drops their tables. Tables which a running addressmerge still
+    has a view of are left for a later run to drop. Returns the number evicted.
+    '''
+    curs = None
+    try:
+        curs = conn.cursor()
+        curs.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'addressmerge_cache');''')
+        if not curs.fetchone()[0]:
+            return 0
+        curs.execute('''SELECT key FROM addressmerge_cache
+                          WHERE %s IS NULL OR key LIKE %s || '%%';''', (key, key))
+        keys = [row[0] for row in curs.fetchall()]
+        for key in keys:
+            # Waits for any run building or opening this area
+            curs.execute('''SELECT pg_advisory_xact_lock(hashtext(%s));''', (key,))
+            curs.execute('''DELETE FROM addressmerge_cache WHERE key = %s;''', (key,))
+        dropped = _drop_unused_cached_tables(curs)
+        if dropped < len(keys):
+            l.info('%d evicted tables are still in use and will be dropped by a later run',
+                   len(keys) - dropped)
+        conn.commit()
+        return len(keys)
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        if curs is not None:
+            curs.close()
+
+def _drop_unused_cached_tables(curs, home=''):
+    '''
+    Drops the cached local_all tables which are no longer in addressmerge_cache.
+    A table is skipped if another run is reading it or has a view of it, and is
+    dropped by a later call. home is the schema of addressmerge_cache with a
+    trailing dot, if it needs qualifying. Returns the number dropped.
+    '''
+    curs.execute('''SELECT c.oid, quote_ident(n.nspname) || '.' || quote_ident(c.relname)
+                      FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                      WHERE c.relkind = 'r' AND c.relname ~ '^addressmerge_local_'
+                        AND c.relnamespace = (SELECT relnamespace FROM pg_class
+                                                WHERE oid = '%saddressmerge_cache'::regclass)
+                        AND c.relname NOT IN (SELECT table_name FROM %saddressmerge_cache);'''
+                 % (home, home))
+    dropped = 0
+    for (oid, table) in curs.fetchall():
+        # Once the lock is held no other run can create a view of the table, so
+        # the dependency check can not be raced
+        curs.execute('''SAVEPOINT drop_cached;''')
+        try:
+            curs.execute('''LOCK TABLE %s IN ACCESS EXCLUSIVE MODE NOWAIT;''' % table)
+        except psycopg2.OperationalError:
+            curs.execute('''ROLLBACK TO SAVEPOINT drop_cached;''')
+            l.debug('Not dropping %s, which is being read', table)
+            continue
+        curs.execute('''SELECT EXISTS (SELECT 1 FROM pg_depend
+                          WHERE refobjid = %s AND classid = 'pg_rewrite'::regclass);''', (oid,))
+        if curs.fetchone()[0]:
+            # Rolling back releases the lock so the run using the table can go on
+            curs.execute('''ROLLBACK TO SAVEPOINT drop_cached;''')
+            l.debug('Not dropping %s, which is still in use', table)
+            continue
+        l.debug('Dropping unused cached table %s', table)
+        curs.execute('''DROP TABLE %s;''' % table)
+        curs.execute('''RELEASE SAVEPOINT drop_cached;''')
+        dropped += 1
+    return dropped
+
+def _normalize(value):
+    '''
+    Case-folds value and collapses its whitespace, like addressmerge_normalize
+    in SQL
+    '''
+    if value is None:
+        return None
+    return u' '.join(value.split()).lower()
+
+def _normalize_street(value, suffixes=None):
+    '''
+    Normalizes a street name, abbreviating its last word if it is in suffixes
+    '''
+    value = _normalize(value)
+    if value and suffixes:
+        words = value.rsplit(u' ', 1)
+        words[-1] = suffixes.get(words[-1], words[-1])
+        value = u' '.join(words)
+    return value
+
+def _address_key(tags, suffixes=None):
+    '''
+    Returns the normalized (housenumber, street, city) of tags, with None for
+    missing tags
+    '''
+    return (_normalize(tags.get('addr:housenumber')),
+            _normalize_street(tags.get('addr:street'), suffixes),
+            _normalize(tags.get('addr:city')))
+
+def read_street_suffixes(f):
+    '''
+    Reads a street suffix table with a suffix and its abbreviation on each
+    line, separated by whitespace. Blank lines and lines starting with # are
+    ignored.
+    '''
+    suffixes = {}
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        (suffix, abbreviation) = line.split()
+        suffixes[_normalize(suffix)] = _normalize(abbreviation)
+    return suffixes
+
+def _copy_escape(value):
+    '''
+    Escapes a string for the COPY text format
+    '''
+    return (value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+                 .replace(u'\n', u'\\n').replace(u'\r', u'\\r'))
+
+def _hstore_quote(value):
+    return u'"' + value.replace(u'\\', u'\\\\').replace(u'"', u'\\"') + u'"'
+
+def _copy_row(id, tags, x, y, context=False):
+    '''
+    Returns one line of COPY text for import_addresses
+    '''
+    hstore = u', '.join(u'%s=>%s' % (_hstore_quote(k), _hstore_quote(v))
+                        for (k, v) in tags.items())
+    return u'%d\tSRID=4326;POINT(%r %r)\t%s\t%s\n' % (id, x, y, _copy_escape(hstore),
+                                                    u't' if context else u'f')
+
+def _conflate_tile(task):
+    '''
+    Runs the change generating matchers for one tile on its own connection.
+    This is run in a worker process by OSMSource.generate_changes.
+
+    Context addresses are loaded so matchers can see addresses just across the
+    tile border but are never matched themselves.
+    '''
+    (index, source_args, nocity, building, core, context) = task
+    l.debug('Conflating tile %d with %d addresses', index, len(core))
+    tile = OSMSource(changes=True, **source_args)
+    try:
+        tile.add_addresses(core)
+        tile.add_addresses(context, context=True)
+        tile.index_addresses()
+        tile.prepare_matching()
+        deleted = tile.generate_changes(nocity=nocity, building=building)
+        return (index, deleted, list(tile.get_changed_nodes()),
+                list(tile.get_changed_ways()), list(tile.get_changed_relations()),
+                tile.get_change_sources(), tile.ambiguous)
+    finally:
+        tile.close()
+
+class Metrics(object):
+    '''
+    Records the wall time of each pipeline stage and the wall time and row
+    count of each SQL statement. If explain is set the EXPLAIN (ANALYZE, BUFFERS)
+    plan of each query is also recorded, which runs every query twice.
+    '''
+    # Statements that EXPLAIN ANALYZE can be run on
+    EXPLAINABLE = frozenset(['SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'])
+    # CREATE TABLE ... AS, which builds local_all and the staging tables
+    CREATE_TABLE_AS = re.compile(r'''\s*CREATE\s+(?:\w+\s+)?TABLE\s+[\w."]+\s*(?:\([^)]*\)\s*)?AS\b''',
+                                 re.IGNORECASE)
+
+    def __init__(self, explain=False):
+        self.explain = explain
+        self.stages = []
+        self.statements = []
+        self._stage = None
+        self._start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        previous = self._stage
+        self._stage = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append({'stage': name, 'seconds': time.time() - start})
+            self._stage = previous
+
+    def cursor_factory(self):
+        '''
+        Returns a cursor class which records its statements in these metrics
+        '''
+        metrics = self
+        class MeasuredCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                return metrics.measure(self, query, vars, super(MeasuredCursor, self).execute,
+                                       explainable=True)
+
+            def executemany(self, query, vars_list):
+                return metrics.measure(self, query, vars_list, super(MeasuredCursor, self).executemany)
+
+            def copy_expert(self, sql, file, *args):
+                return metrics.measure(self, sql, file,
+                                       lambda sql, file: super(MeasuredCursor, self).copy_expert(sql, file, *args))
+        return MeasuredCursor
+
+    def measure(self, curs, query, vars, execute, explainable=False):
+        plan = None
+        if self.explain and explainable and curs.name is None:
+            plan = self._explain(curs, query, vars, execute)
+        start = time.time()
+        try:
+            return execute(query, vars)
+        finally:
+            self.statements.append({'stage': self._stage,
+                                    'query': ' '.join(query.split()),
+                                    'seconds': time.time() - start,
+                                    'rows': curs.rowcount,
+                                    'plan': plan})
+
+    def _explain(self, curs, query, vars, execute):
+        if (query.split(None, 1)[0].upper() not in self.EXPLAINABLE
+                and not self.CREATE_TABLE_AS.match(query)):
+            return None
+        try:
+            execute('''SAVEPOINT addressmerge_explain;''')
+        except psycopg2.Error as e:
+            l.warning('Not explaining statement outside of a transaction: %s', e)
+            return None
+        try:
+            execute('''EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ''' + query, vars)
+            return curs.fetchone()[0]
+        except psycopg2.Error as e:
+            l.warning('Could not explain statement: %s', e)
+            return None
+        finally:
+            execute('''ROLLBACK TO SAVEPOINT addressmerge_explain;''')
+
+    def report(self):
+        return {'seconds': time.time() - self._start,
+                'stages': self.stages,
+                'statements': self.statements}
+
+    def write(self, f):
+        json.dump(self.report(), f, indent=2)
+        f.write('\n')
 
 class OSMSource(object):
-    def __init__(self, database, user, password, host, port, wkt, strippable, changes, buffer):
-        l.debug('Connecting to postgresql')
-        self._conn=psycopg2.connect(database=database, user=user, 
-                                    password=password, host=host, 
-                                    port=str(port))
-        self._conn.set_session(readonly=False, autocommit=False)
-        psycopg2.extras.register_hstore(self._conn, unicode=True)
+    # The objects of local_all each matcher reads, as the types and the subset
+    # of those types. local_all only holds what the enabled matchers need.
+    REQUIREMENTS = {'duplicates': [('NWM', 'addressed')],
+                    'nocity': [('NWM', 'addressed')],
+                    'building': [('N', 'addressed'), ('WM', 'building')]}
+    SUBSETS = {'addressed': "%(tags)s ? 'addr:housenumber'",
+               'building': "%(tags)s ? 'building'"}
+
+    def __init__(self, database, user, password, host, port, wkt, strippable, changes, buffer,
+                 load_method='copy', copy_batch=10000, itersize=2000, metrics=None,
+                 cache=False, suffixes=None, distance_method='buffer', matchers=None,
+                 conn=None, cache_wkt=None, unlogged=False, settings=None, connected=None):
+        '''
+        If conn is given it is used instead of connecting, and must already have
+        hstore registered. close then resets its session instead of closing it.
+
+        cache_wkt is the area to cache with cache, which must contain wkt. This
+        lets runs over overlapping areas share one cached table.
+
+        With unlogged the working tables are unlogged tables in a schema for
+        this run instead of temporary tables, so that queries on them can use
+        parallel workers. settings is a dict of configuration parameters like
+        work_mem set for the session.
+
+        connected is called with the connection before any tables are created,
+        so that another thread can cancel the queries on it.
+        '''
+        self._connect_args = dict(database=database, user=user,
+                                  password=password, host=host,
+                                  port=str(port))
+        self._owns_conn = conn is None
+        if conn is None:
+            l.debug('Connecting to postgresql')
+            self._conn=psycopg2.connect(**self._connect_args)
+            self._conn.set_session(readonly=False, autocommit=False)
+            psycopg2.extras.register_hstore(self._conn, unicode=True)
+        else:
+            self._conn = conn
+        if metrics is not None:
+            self._conn.cursor_factory = metrics.cursor_factory()
         self.wkt = wkt
+        self.cache_wkt = cache_wkt if cache and cache_wkt else wkt
         self.strippable = strippable
         self.buffer = buffer
-        self.validate_wkt()
-        self.create_tables()
-        if changes:
-            self.create_change_tables()
+        self.load_method = load_method
+        self.copy_batch = copy_batch
+        self.itersize = itersize
+        self.cache = cache
+        self.changes = changes
+        self.suffixes = suffixes or {}
+        self.distance_method = distance_method
+        self.matchers = sorted(matchers if matchers is not None else self.REQUIREMENTS)
+        self.unlogged = unlogged
+        self.settings = settings or {}
+        self._persistence = 'UNLOGGED' if unlogged else 'TEMPORARY'
+        self._schema = None
+        self._home = None
+        self._load_count = 0
+        self._load_time = 0.0
+        self.ambiguous = []
+        try:
+            if connected is not None:
+                connected(self._conn)
+            self._prepare_session()
+            self.validate_wkt()
+            self.create_tables()
+            if changes:
+                self.create_change_tables()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._schema is not None:
+            curs = None
+            try:
+                self._conn.rollback()
+                curs = self._conn.cursor()
+                curs.execute('''DROP SCHEMA IF EXISTS %s CASCADE;''' % self._schema)
+                curs.connection.commit()
+                self._schema = None
+            finally:
+                if curs is not None:
+                    curs.close()
+        if self._owns_conn:
+            self._conn.close()
+            return
+        # Drop this run's temporary tables and functions and reset its settings,
+        # search_path and locks so the connection can be reused
+        self._conn.rollback()
+        self._conn.autocommit = True
+        curs = self._conn.cursor()
+        try:
+            curs.execute('''DISCARD ALL;''')
+        finally:
+            curs.close()
+            self._conn.autocommit = False
+
+    def _prepare_session(self):
+        '''
+        Applies self.settings and with unlogged creates the schema for this run,
+        putting it first on the search_path. The schema is locked for as long as
+        the session lasts, so schemas left by runs which crashed can be told apart
+        from those in use and are dropped.
+        '''
+        if not self.settings and not self.unlogged:
+            return
+        curs = None
+        try:
+            curs = self._conn.cursor()
+            for (name, value) in sorted(self.settings.items()):
+                curs.execute('''SELECT set_config(%s, %s, FALSE);''', (name, str(value)))
+            if self.unlogged:
+                self._drop_stale_schemas(curs)
+                # Cached areas stay in the schema that would otherwise be used
+                curs.execute('''SELECT quote_ident(current_schema());''')
+                self._home = curs.fetchone()[0]
+                schema = 'addressmerge_run_%s' % uuid.uuid4().hex
+                l.debug('Creating schema %s', schema)
+                curs.execute('''CREATE SCHEMA %s;''' % schema)
+                self._schema = schema
+                curs.execute('''SELECT pg_advisory_lock(hashtext('addressmerge_run'), hashtext(%s));''',
+                             (schema,))
+                curs.execute('''SELECT set_config('search_path', %s || ', ' || current_setting('search_path'), FALSE);''',
+                             (schema,))
+            curs.connection.commit()
+        except BaseException:
+            if curs is not None:
+                curs.connection.rollback()
+            # The schema is not created if the transaction was rolled back
+            self._schema = None
+            raise
+        finally:
+            if curs is not None:
+                curs.close()
+
+    def _drop_stale_schemas(self, curs):
+        '''
+        Drops the schemas of runs with --unlogged which are no longer connected
+        '''
+        curs.execute('''SELECT nspname FROM pg_namespace
+                          WHERE nspname ~ '^addressmerge_run_[0-9a-f]+$';''')
+        for (schema,) in curs.fetchall():
+            curs.execute('''SELECT pg_try_advisory_xact_lock(hashtext('addressmerge_run'), hashtext(%s));''',
+                         (schema,))
+            if curs.fetchone()[0]:
+                l.info('Dropping schema %s left by an earlier run', schema)
+                curs.execute('''DROP SCHEMA IF EXISTS %s CASCADE;''' % schema)
 
     def validate_wkt(self):
         '''
@@ -45,9 +633,16 @@ class OSMSource(object):
         curs = None
         try:
             curs = self._conn.cursor()
-            curs.execute('''SELECT 9e-6/cos(radians(greatest(abs(ST_YMax(wkt.geom)), abs(ST_YMin(wkt.geom)))))
+            curs.execute('''SELECT 9e-6/cos(radians(greatest(abs(ST_YMax(wkt.geom)), abs(ST_YMin(wkt.geom))))),
+                              ST_XMin(wkt.geom), ST_YMin(wkt.geom), ST_XMax(wkt.geom), ST_YMax(wkt.geom)
                               FROM (SELECT ST_GeomFromText(%s, 4326) AS geom) AS wkt;;''', (self.wkt,))
-            self.scale = curs.fetchone()[0]
+            row = curs.fetchone()
+            self.scale = row[0]
+            self.extent = row[1:]
+            # The UTM zone containing the centre of the area
+            (xmin, ymin, xmax, ymax) = self.extent
+            zone = min(int(math.floor(((xmin + xmax) / 2 + 180) / 6)) + 1, 60)
+            self.srid = (32600 if ymin + ymax >= 0 else 32700) + zone
             curs.connection.rollback()
         except BaseException:
             if curs is not None:
@@ -59,23 +654,31 @@ class OSMSource(object):
 
     def create_tables(self):
         l.debug('Creating tables')
+        if self.cache:
+            self._create_cache_registry()
         curs = None
         try:
             curs = self._conn.cursor()
-            curs.execute('''CREATE TEMPORARY TABLE import_addresses
+            curs.execute('''CREATE %s TABLE import_addresses
                             (import_id integer PRIMARY KEY,
                             geom geometry,
                             tags hstore,
-                            pending_delete boolean DEFAULT FALSE);''')
+                            pending_delete boolean DEFAULT FALSE,
+                            context boolean DEFAULT FALSE,
+                            addr_key text,
+                            addr_hash bigint,
+                            street_key text,
+                            street_hash bigint);''' % self._persistence)
+            self._create_key_functions(curs)
 
             curs.execute('''CREATE TEMPORARY VIEW local_nodes AS
                             SELECT id, tags, geom FROM nodes
                             WHERE ST_Intersects(geom, ST_GeomFromText(%s,4326));''',
-                            (self.wkt,))
+                            (self.cache_wkt,))
             curs.execute('''CREATE TEMPORARY VIEW local_ways AS
                             SELECT id, tags, linestring AS geom FROM ways
                             WHERE ST_Intersects(linestring,ST_GeomFromText(%s,4326));''',
-                            (self.wkt,))
+                            (self.cache_wkt,))
             curs.execute('''CREATE TEMPORARY VIEW local_mps AS
                             SELECT relation_id AS id,
                                 relation_tags AS tags,
@@ -87,29 +690,16 @@ class OSMSource(object):
                             AND relation_members.member_type='W')
                             JOIN relations
                             ON (relation_members.relation_id = relations.id)
-                            WHERE relations.tags @> hstore('type','multipolygon'))
+                            WHERE relations.tags @> hstore('type','multipolygon')
+                            AND %s)
                             AS relation_ways
-                            GROUP BY relation_id, relation_tags;''')
+                            GROUP BY relation_id, relation_tags;'''
+                            % self._local_filters().get('M', 'FALSE') % {'tags': 'relations.tags'})
 
-            curs.execute('''CREATE TEMPORARY TABLE local_all
-                            (id, type, geom, tags)
-                            AS (SELECT id, type, geom, tags FROM (SELECT local_nodes.id, 'N'::character(1) AS type,
-                                local_nodes.tags, local_nodes.geom FROM local_nodes
-                            UNION ALL SELECT local_ways.id, 'W'::character(1) AS type,
-                                local_ways.tags, local_ways.geom FROM local_ways
-                            UNION ALL SELECT local_mps.id, 'M'::character(1) AS type,
-                                local_mps.tags, local_mps.geom FROM local_mps) AS everything);''')
-
-            l.debug('Indexing and analyzing tables')
-            curs.execute('''ALTER TABLE local_all ADD PRIMARY KEY (type, id) WITH (FILLFACTOR=100);''')
-            curs.execute('''CREATE INDEX ON local_all USING gist (geom) WITH (FILLFACTOR=100);''')
-            curs.execute('''CREATE INDEX local_all_addr_idx ON local_all USING btree
-                            ((local_all.tags -> 'addr:housenumber'),
-                            (local_all.tags -> 'addr:street'),
-                            (local_all.tags -> 'addr:city'))
-                             WITH (FILLFACTOR=100)''')
-
-            curs.execute('''ANALYZE local_all;''')
+            if self.cache:
+                self._cached_local_all(curs)
+            else:
+                self._create_local_all(curs, 'local_all', self._persistence)
 
             l.debug('Committing transaction')
             curs.connection.commit()
@@ -122,27 +712,206 @@ class OSMSource(object):
             if curs is not None:
                 curs.close()
 
+    def _create_key_functions(self, curs):
+        '''
+        Creates the street suffix table and the session functions that build
+        normalized address keys. addr_key is the housenumber, street and city
+        used for duplicates, and street_key is the housenumber and street used
+        by nocity. Either is NULL if one of its tags is missing.
+
+        With unlogged the functions are in the run's schema and marked parallel
+        safe, otherwise they are in pg_temp.
+        '''
+        curs.execute('''CREATE %s TABLE street_suffixes
+                        (suffix text PRIMARY KEY,
+                        abbreviation text NOT NULL);''' % self._persistence)
+        curs.executemany('''INSERT INTO street_suffixes (suffix, abbreviation)
+                            VALUES (%s, %s);''', sorted(self.suffixes.items()))
+        names = {'schema': self._functions, 'parallel': ' PARALLEL SAFE' if self.unlogged else ''}
+        curs.execute('''CREATE FUNCTION %(schema)s.addressmerge_normalize(value text) RETURNS text AS $$
+                          SELECT lower(regexp_replace(regexp_replace(value, '[[:space:]]+', ' ', 'g'), '^ | $', '', 'g'))
+                        $$ LANGUAGE sql IMMUTABLE%(parallel)s;''' % names)
+        curs.execute('''CREATE FUNCTION %(schema)s.addressmerge_street(value text) RETURNS text AS $$
+                          SELECT COALESCE(regexp_replace(normalized.value, '[^ ]+$', '') || street_suffixes.abbreviation,
+                                          normalized.value)
+                            FROM (SELECT %(schema)s.addressmerge_normalize(value) AS value) AS normalized
+                            LEFT JOIN street_suffixes
+                              ON street_suffixes.suffix = substring(normalized.value from '[^ ]+$')
+                        $$ LANGUAGE sql STABLE%(parallel)s;''' % names)
+        curs.execute('''CREATE FUNCTION %(schema)s.addressmerge_key(tags hstore, city boolean) RETURNS text AS $$
+                          SELECT %(schema)s.addressmerge_normalize(tags -> 'addr:housenumber') || chr(31)
+                            || %(schema)s.addressmerge_street(tags -> 'addr:street')
+                            || CASE WHEN city THEN chr(31) || %(schema)s.addressmerge_normalize(tags -> 'addr:city')
+                               ELSE '' END
+                        $$ LANGUAGE sql STABLE%(parallel)s;''' % names)
+        # 64 bits of the md5, so a hash join almost never needs to recheck the key
+        curs.execute('''CREATE FUNCTION %(schema)s.addressmerge_hash(key text) RETURNS bigint AS $$
+                          SELECT ('x' || substr(md5(key), 1, 16))::bit(64)::bigint
+                        $$ LANGUAGE sql IMMUTABLE%(parallel)s;''' % names)
+
+    @property
+    def _functions(self):
+        '''
+        The schema holding the key functions and staging tables
+        '''
+        return self._schema or 'pg_temp'
+
+    def _local_filters(self):
+        '''
+        Returns the condition on tags for each type of object needed by the
+        enabled matchers, with %(tags)s for the tags column
+        '''
+        subsets = {}
+        for matcher in self.matchers:
+            for (types, subset) in self.REQUIREMENTS[matcher]:
+                for type in types:
+                    subsets.setdefault(type, set()).add(subset)
+        return dict((type, '(' + ' OR '.join(self.SUBSETS[subset] for subset in sorted(subsets[type])) + ')')
+                    for type in subsets)
+
+    def _create_local_all(self, curs, table, persistence):
+        '''
+        Creates and indexes table with the parts of local_nodes, local_ways and
+        local_mps needed by the enabled matchers
+        '''
+        filters = self._local_filters()
+        parts = []
+        for (type, view) in (('N', 'local_nodes'), ('W', 'local_ways'), ('M', 'local_mps')):
+            if type in filters:
+                parts.append('''SELECT %s.id, '%s'::character(1) AS type,
+                            %s.tags, %s.geom FROM %s
+                            WHERE %s''' % (view, type, view, view, view,
+                                           filters[type] % {'tags': view + '.tags'}))
+        l.debug('Building local_all for %s', ', '.join(self.matchers))
+        curs.execute('''CREATE %(persistence)s TABLE %(table)s
+                        (id, type, geom, tags, addr_key, addr_hash, street_key, street_hash, pgeom)
+                        AS (SELECT id, type, geom, tags,
+                            addr_key, %(schema)s.addressmerge_hash(addr_key),
+                            street_key, %(schema)s.addressmerge_hash(street_key),
+                            %(pgeom)s
+                        FROM (SELECT id, type, geom, tags,
+                            %(schema)s.addressmerge_key(tags, TRUE) AS addr_key,
+                            %(schema)s.addressmerge_key(tags, FALSE) AS street_key
+                        FROM (%(parts)s) AS everything) AS keyed);'''
+                        % {'persistence': persistence, 'table': table, 'schema': self._functions,
+                           'pgeom': 'ST_Transform(geom, %d)' % self.srid if self.distance_method == 'projected'
+                                    else 'NULL::geometry',
+                           'parts': '''
+                        UNION ALL '''.join(parts)})
+        # Index names can not be schema qualified
+        name = table.rpartition('.')[2]
+
+        l.debug('Indexing and analyzing tables')
+        curs.execute('''ALTER TABLE %s ADD PRIMARY KEY (type, id) WITH (FILLFACTOR=100);''' % table)
+        curs.execute('''CREATE INDEX ON %s USING gist (geom) WITH (FILLFACTOR=100);''' % table)
+        if self.distance_method == 'projected':
+            curs.execute('''CREATE INDEX ON %s USING gist (pgeom) WITH (FILLFACTOR=100);''' % table)
+        curs.execute('''CREATE INDEX %s_addr_hash_idx ON %s USING btree (addr_hash)
+                        WITH (FILLFACTOR=100) WHERE addr_hash IS NOT NULL;''' % (name, table))
+        curs.execute('''CREATE INDEX %s_street_hash_idx ON %s USING btree (street_hash)
+                        WITH (FILLFACTOR=100) WHERE street_hash IS NOT NULL;''' % (name, table))
+
+        curs.execute('''ANALYZE %s;''' % table)
+
+    def _cache_key(self):
+        '''
+        Returns a hash of everything that determines the contents of local_all
+        '''
+        return hashlib.md5(json.dumps([CACHE_VERSION, self.cache_wkt, sorted(self.suffixes.items()),
+                                       self.srid if self.distance_method == 'projected' else None,
+                                       self.matchers])
+                           .encode('utf-8')).hexdigest()
+
+    def _create_cache_registry(self):
+        '''
+        Creates addressmerge_cache if it does not exist. Concurrent runs can not
+        create it at the same time, so this takes a lock and commits at once to
+        avoid holding it while tables are built.
+        '''
+        home = '' if self._home is None else self._home + '.'
+        curs = None
+        try:
+            curs = self._conn.cursor()
+            curs.execute('''SELECT pg_advisory_xact_lock(hashtext('addressmerge_cache'));''')
+            curs.execute('''CREATE TABLE IF NOT EXISTS %saddressmerge_cache
+                            (key text PRIMARY KEY,
+                            table_name text NOT NULL,
+                            wkt text NOT NULL,
+                            state text,
+                            created timestamp with time zone DEFAULT now(),
+                            used timestamp with time zone DEFAULT now());''' % home)
+            curs.connection.commit()
+        except BaseException:
+            if curs is not None:
+                curs.connection.rollback()
+            raise
+        finally:
+            if curs is not None:
+                curs.close()
+
+    def _cached_local_all(self, curs):
+        '''
+        Makes local_all a view of a persistent table for this area, building the
+        table if it is not cached or the OSM data has changed since it was built.
+
+        Other runs may still have views of a table being replaced, so every build
+        gets a new table name and old tables are only dropped once unused.
+        '''
+        key = self._cache_key()
+        # With unlogged the run's schema is first on the search_path, so the
+        # persistent tables are created in the schema that would have been used
+        home = '' if self._home is None else self._home + '.'
+        # Concurrent runs over the same area wait for the first to build the table
+        curs.execute('''SELECT pg_advisory_xact_lock(hashtext(%s));''', (key,))
+        state = _data_state(curs)
+        curs.execute('''SELECT table_name, state FROM addressmerge_cache
+                          WHERE key = %s
+                          AND EXISTS (SELECT 1 FROM pg_tables WHERE tablename = table_name);''', (key,))
+        row = curs.fetchone()
+        if row is not None and row[1] == state:
+            table = home + row[0]
+            l.info('Using cached local_all %s', table)
+            curs.execute('''UPDATE addressmerge_cache SET used = now() WHERE key = %s;''', (key,))
+        else:
+            name = 'addressmerge_local_%s_%s' % (key[:16], uuid.uuid4().hex[:8])
+            table = home + name
+            l.info('Building cached local_all %s', table)
+            self._create_local_all(curs, table, '')
+            curs.execute('''DELETE FROM addressmerge_cache WHERE key = %s;''', (key,))
+            curs.execute('''INSERT INTO addressmerge_cache (key, table_name, wkt, state)
+                            VALUES (%s, %s, %s, %s);''', (key, name, self.cache_wkt, state))
+            _drop_unused_cached_tables(curs, home)
+        if self.cache_wkt == self.wkt:
+            curs.execute('''CREATE TEMPORARY VIEW local_all AS SELECT * FROM %s;''' % table)
+        else:
+            curs.execute('''CREATE TEMPORARY VIEW local_all AS SELECT * FROM %s
+                            WHERE ST_Intersects(geom, ST_GeomFromText(%%s, 4326));''' % table,
+                         (self.wkt,))
+
     def create_change_tables(self):
         curs = None
         try:
             curs = self._conn.cursor()
-            curs.execute('''CREATE TEMPORARY TABLE changed_nodes
+            curs.execute('''CREATE %s TABLE changed_nodes
                             (id bigint PRIMARY KEY CHECK (id > 0),
                             version integer CHECK (version >= 1),
                             tags hstore,
-                            geom geometry);''')
-            curs.execute('''CREATE TEMPORARY TABLE changed_ways
+                            geom geometry,
+                            import_id integer);''' % self._persistence)
+            curs.execute('''CREATE %s TABLE changed_ways
                             (id bigint PRIMARY KEY CHECK (id > 0),
                             version integer CHECK (version >= 1),
                             tags hstore,
-                            nodes bigint[]);''')
-            curs.execute('''CREATE TEMPORARY TABLE changed_relations
+                            nodes bigint[],
+                            import_id integer);''' % self._persistence)
+            curs.execute('''CREATE %s TABLE changed_relations
                             (id bigint PRIMARY KEY CHECK (id > 0),
                             version integer CHECK (version >= 1),
                             tags hstore,
                             types character(1)[],
                             ids bigint[],
-                            roles text[]);''')
+                            roles text[],
+                            import_id integer);''' % self._persistence)
         except BaseException:
             if curs is not None:
                 curs.connection.rollback()
@@ -152,21 +921,53 @@ class OSMSource(object):
                 curs.close()
 
     def load_addresses(self, addresses):
-        l.debug('Loading addresses')
+        self.add_addresses(addresses)
+        self.index_addresses()
+
+    def add_addresses(self, addresses, context=False):
+        '''
+        Adds addresses to import_addresses without committing. This can be called
+        repeatedly to stream addresses in, followed by index_addresses.
+
+        Context addresses are considered by matchers that look at nearby import
+        addresses but are never themselves removed or matched.
+        '''
+        curs = None
+        try:
+            curs = self._conn.cursor()
+            start = time.time()
+            if self.load_method == 'copy':
+                self._load_count += self._copy_addresses(curs, addresses, context)
+            else:
+                self._load_count += self._insert_addresses(curs, addresses, context)
+            self._load_time += time.time() - start
+        except BaseException:
+            if curs is not None:
+                curs.connection.rollback()
+            raise
+        finally:
+            if curs is not None:
+                curs.close()
+
+    def index_addresses(self):
+        l.info('Loaded %d addresses with %s in %.2fs (%.0f rows/s)', self._load_count,
+               self.load_method, self._load_time,
+               self._load_count/self._load_time if self._load_time > 0 else 0)
         curs = None
         try:
             curs = self._conn.cursor()
-            for (id, tags, (x, y)) in addresses:
-                curs.execute('''INSERT INTO import_addresses
-                                (import_id, geom, tags)
-                                VALUES (%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s);''',
-                                (id, x, y, tags))
+            l.debug('Building address keys')
+            curs.execute('''UPDATE import_addresses
+                            SET addr_key = %(schema)s.addressmerge_key(tags, TRUE),
+                            addr_hash = %(schema)s.addressmerge_hash(%(schema)s.addressmerge_key(tags, TRUE)),
+                            street_key = %(schema)s.addressmerge_key(tags, FALSE),
+                            street_hash = %(schema)s.addressmerge_hash(%(schema)s.addressmerge_key(tags, FALSE));'''
+                         % {'schema': self._functions})
             l.debug('Indexing and analyzing tables')
-            curs.execute('''CREATE INDEX import_addresses_addr_idx ON import_addresses USING btree
-                            ((import_addresses.tags -> 'addr:housenumber'),
-                            (import_addresses.tags -> 'addr:street'),
-                            (import_addresses.tags -> 'addr:city'))
-                            WITH (FILLFACTOR=100);''')
+            curs.execute('''CREATE INDEX import_addresses_addr_hash_idx ON import_addresses
+                            USING btree (addr_hash) WITH (FILLFACTOR=100);''')
+            curs.execute('''CREATE INDEX import_addresses_street_hash_idx ON import_addresses
+                            USING btree (street_hash) WITH (FILLFACTOR=100);''')
             curs.execute('''ANALYZE import_addresses;''')
             curs.connection.commit()
         except BaseException:
@@ -177,34 +978,98 @@ class OSMSource(object):
             if curs is not None:
                 curs.close()
 
+    def _insert_addresses(self, curs, addresses, context=False):
+        '''
+        Loads addresses with one INSERT per address. This is slower than COPY
+        but is kept as a fallback for servers or poolers where COPY is unavailable
+        '''
+        count = 0
+        for (id, tags, (x, y)) in addresses:
+            curs.execute('''INSERT INTO import_addresses
+                            (import_id, geom, tags, context)
+                            VALUES (%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s);''',
+                            (id, x, y, tags, context))
+            count += 1
+        return count
+
+    def _copy_addresses(self, curs, addresses, context=False):
+        '''
+        Loads addresses with COPY in batches of self.copy_batch rows. Geometries
+        are sent as EWKT and tags as hstore text so the server builds both.
+        '''
+        count = 0
+        batch = []
+        for (id, tags, (x, y)) in addresses:
+            batch.append(_copy_row(id, tags, x, y, context))
+            if len(batch) >= self.copy_batch:
+                count += self._copy_batch(curs, batch)
+                batch = []
+        if batch:
+            count += self._copy_batch(curs, batch)
+        return count
+
+    def _copy_batch(self, curs, rows):
+        data = io.BytesIO(u''.join(rows).encode('utf-8'))
+        curs.copy_expert('''COPY import_addresses (import_id, geom, tags, context) FROM STDIN;''', data)
+        return len(rows)
+
     def find_duplicates(self):
         l.debug('Finding duplicates')
         curs = None
         try:
             curs = self._conn.cursor()
             curs.execute('''DELETE FROM import_addresses USING local_all
-                            WHERE local_all.tags -> 'addr:housenumber' = import_addresses.tags -> 'addr:housenumber'
-                            AND (local_all.tags -> 'addr:housenumber') IS NOT NULL
-                            AND local_all.tags -> 'addr:street' = import_addresses.tags -> 'addr:street'
-                            AND (local_all.tags -> 'addr:housenumber') IS NOT NULL
-                            AND local_all.tags -> 'addr:city' = import_addresses.tags -> 'addr:city'
-                            AND (local_all.tags -> 'addr:housenumber') IS NOT NULL
+                            WHERE local_all.addr_hash = import_addresses.addr_hash
+                            AND local_all.addr_key = import_addresses.addr_key
+                            AND NOT import_addresses.context
                             RETURNING import_addresses.import_id;''')
             deleted = set(id[0] for id in curs.fetchall())
+            curs.connection.commit()
+        except BaseException:
+            if curs is not None:
+                curs.connection.rollback()
+            raise
+        finally:
+            if curs is not None:
+                curs.close()
+        self.prepare_matching()
+        return deleted
+
+    def prepare_matching(self):
+        '''
+        Builds the buffered or projected geometries and spatial indexes on
+        import_addresses used by the change generating matchers
+        '''
+        curs = None
+        try:
+            curs = self._conn.cursor()
             curs.execute('''ALTER TABLE import_addresses
-                            ADD COLUMN buffered_geom geometry;''')
-            curs.execute('''UPDATE import_addresses
-                            SET buffered_geom = geometry(ST_Buffer(geography(geom),%s));''',
-                            (self.buffer,))
-            curs.execute('''CREATE INDEX ON import_addresses
-                            USING gist (buffered_geom)
-                            WITH (FILLFACTOR=100);''')
+                            ADD COLUMN buffered_geom geometry,
+                            ADD COLUMN pgeom geometry;''')
+            if self.distance_method == 'buffer':
+                curs.execute('''UPDATE import_addresses
+                                SET buffered_geom = geometry(ST_Buffer(geography(geom),%s));''',
+                                (self.buffer,))
+                curs.execute('''CREATE INDEX ON import_addresses
+                                USING gist (buffered_geom)
+                                WITH (FILLFACTOR=100);''')
+            elif self.distance_method == 'projected':
+                curs.execute('''UPDATE import_addresses
+                                SET pgeom = ST_Transform(geom, %s);''', (self.srid,))
+                curs.execute('''CREATE INDEX ON import_addresses
+                                USING gist (pgeom)
+                                WITH (FILLFACTOR=100);''')
             curs.execute('''CREATE INDEX ON import_addresses
                             USING gist (geom)
                             WITH (FILLFACTOR=100);''')
-            curs.execute('''COMMIT;''')
-            curs.execute('''VACUUM ANALYZE import_addresses;''')
-            return deleted
+            curs.connection.commit()
+            # VACUUM can't run in a transaction. Switching to autocommit keeps
+            # psycopg2's idea of the transaction in step with the server's
+            self._conn.autocommit = True
+            try:
+                curs.execute('''VACUUM ANALYZE import_addresses;''')
+            finally:
+                self._conn.autocommit = False
         except BaseException:
             if curs is not None:
                 curs.connection.rollback()
@@ -213,132 +1078,197 @@ class OSMSource(object):
             if curs is not None:
                 curs.close()
 
-    def generate_changes(self, nocity=None, building=None):
+    def _within(self, a, b, distance):
+        '''
+        Returns an SQL condition for the geometries of the rows a and b being
+        within distance meters, and its parameters.
+
+        buffer intersects b with a geography buffer of an import address a,
+        dwithin uses ST_DWithin on geographies after a bounding box test and
+        projected uses ST_DWithin on the geometries projected to UTM. When a is
+        not an import address buffer tests distances like dwithin.
+        '''
+        if self.distance_method == 'projected':
+            return ('''ST_DWithin(%s.pgeom, %s.pgeom, %%s)''' % (a, b), (distance,))
+        if self.distance_method == 'buffer' and a == 'import_addresses':
+            if distance == self.buffer:
+                return ('''%s.buffered_geom && %s.geom AND ST_Intersects(%s.buffered_geom, %s.geom)'''
+                        % (a, b, a, b), ())
+            return ('''ST_Intersects(ST_Buffer(geography(%s.geom),%%s)::geometry,%s.geom)''' % (a, b),
+                    (distance,))
+        return ('''ST_Expand(%s.geom, %%s) && %s.geom
+                   AND ST_DWithin(geography(%s.geom), geography(%s.geom), %%s, FALSE)''' % (a, b, a, b),
+                (distance * self.scale, distance))
+
+    def _create_buildings(self, curs):
+        '''
+        Creates local_buildings with the polygons of the unaddressed buildings in
+        local_all. Multipolygon buildings are assembled from all of their member
+        ways, including those outside the WKT.
+        '''
+        curs.execute(self._staging_table('local_buildings') + ''' AS
+                        SELECT type, id, tags, geom, COALESCE(ST_IsValid(geom), FALSE) AS valid, %s AS pgeom
+                        FROM (SELECT type, id, tags,
+                            CASE WHEN ST_NPoints(geom) >= 4 THEN ST_MakePolygon(geom) END AS geom
+                          FROM local_all
+                          WHERE type = 'W'
+                            AND tags ? 'building' -- well-formed buildings without addresses
+                            AND (tags -> 'addr:housenumber') IS NULL
+                            AND ST_IsClosed(geom)
+                        UNION ALL
+                        SELECT local_all.type, local_all.id, local_all.tags,
+                            ST_BuildArea(ST_Collect(ways.linestring)) AS geom
+                          FROM local_all JOIN relation_members
+                          ON (local_all.id = relation_members.relation_id
+                          AND relation_members.member_type = 'W')
+                          JOIN ways ON relation_members.member_id = ways.id
+                          WHERE local_all.type = 'M'
+                            AND local_all.tags ? 'building'
+                            AND (local_all.tags -> 'addr:housenumber') IS NULL
+                          GROUP BY local_all.type, local_all.id, local_all.tags) AS buildings;'''
+                        % ('ST_Transform(geom, %d)' % self.srid if self.distance_method == 'projected'
+                           else 'NULL::geometry'))
+        curs.execute('''CREATE INDEX ON local_buildings USING gist (geom) WITH (FILLFACTOR=100);''')
+        if self.distance_method == 'projected':
+            curs.execute('''CREATE INDEX ON local_buildings USING gist (pgeom) WITH (FILLFACTOR=100);''')
+        curs.execute('''ANALYZE local_buildings;''')
+
+    def _staging_table(self, name):
+        '''
+        Returns the start of the CREATE statement for a table which is only
+        needed by generate_changes, which drops it before committing
+        '''
+        if self.unlogged:
+            return '''CREATE UNLOGGED TABLE %s''' % name
+        return '''CREATE TEMPORARY TABLE %s''' % name
+
+    def _insert_changes(self, curs, matches, condition):
+        '''
+        Adds the objects in the staging table matches, with columns import_id,
+        type, id and merged_tags, to the changed tables and marks their import
+        addresses for deletion. Only rows meeting condition are used.
+        '''
+        curs.execute('''INSERT INTO changed_nodes (id, version, tags, geom, import_id)
+                        SELECT nodes.id, nodes.version, matches.merged_tags, nodes.geom, matches.import_id
+                        FROM %s AS matches JOIN nodes ON matches.id=nodes.id
+                        WHERE matches.type='N'
+                        AND %s;''' % (matches, condition))
+        curs.execute('''INSERT INTO changed_ways (id, version, tags, nodes, import_id)
+                        SELECT ways.id, ways.version, matches.merged_tags, ways.nodes, matches.import_id
+                        FROM %s AS matches JOIN ways ON matches.id=ways.id
+                        WHERE matches.type='W'
+                        AND %s;''' % (matches, condition))
+        # no one likes relations, but we need to support them
+        curs.execute('''INSERT INTO changed_relations
+                        (id, version, tags, types, ids, roles, import_id)
+                        SELECT id, version, tags,
+                        array_agg(member_type) AS types,
+                        array_agg(member_id) AS ids,
+                        array_agg(member_role) AS roles,
+                        import_id
+                        FROM (SELECT relations.id, (relations.version + 1) AS version,
+                        merged_tags AS tags, import_id,
+                        member_type, member_id, member_role
+                        FROM %s AS matches JOIN relations
+                        ON matches.id=relations.id
+                        JOIN relation_members
+                        ON relations.id = relation_members.relation_id
+                        WHERE matches.type='M'
+                        AND %s
+                        ORDER BY sequence_id ASC) AS combined_relations
+                        GROUP BY id,version,tags,import_id;''' % (matches, condition))
+        curs.execute('''UPDATE import_addresses
+                        SET pending_delete = TRUE
+                        FROM %s AS matches
+                        WHERE import_addresses.import_id = matches.import_id
+                        AND %s;''' % (matches, condition))
+
+    def generate_changes(self, nocity=None, building=None, jobs=1):
+        for (matcher, distance) in (('nocity', nocity), ('building', building)):
+            if distance is not None and matcher not in self.matchers:
+                raise ValueError('local_all was built without the %s matcher' % matcher)
+        if jobs > 1 and (nocity is not None or building is not None):
+            return self._generate_changes_tiled(nocity, building, jobs)
         deleted = set()
         curs = None
         try:
             curs = self._conn.cursor()
             if nocity is not None:
-                curs.execute('''WITH to_delete AS
-                                (UPDATE import_addresses
+                (within, within_params) = self._within('import_addresses', 'local_all', nocity)
+                # Find every candidate in one pass. An import address with several
+                # candidates, or an object which is a candidate for several import
+                # addresses, is ambiguous and is reported instead of changed.
+                # Context addresses are candidates too so that an address in a
+                # neighbouring tile makes an object ambiguous, but they are never
+                # changed or reported themselves.
+                curs.execute(self._staging_table('nocity_matches') + ''' AS
+                                SELECT import_id, context, type, id, merged_tags,
+                                (count(*) OVER (PARTITION BY import_id) > 1
+                                OR count(*) OVER (PARTITION BY type, id) > 1) AS ambiguous
+                                FROM (SELECT import_addresses.import_id, import_addresses.context,
+                                local_all.type, local_all.id,
+                                (import_addresses.tags || local_all.tags) AS merged_tags
+                                FROM import_addresses JOIN local_all
+                                ON import_addresses.street_hash = local_all.street_hash
+                                WHERE import_addresses.street_key = local_all.street_key
+                                AND ''' + within + ''') AS candidates;''', within_params)
+                self._insert_changes(curs, 'nocity_matches', 'NOT matches.ambiguous AND NOT matches.context')
+                curs.execute('''SELECT import_id, type, id FROM nocity_matches
+                                WHERE ambiguous AND NOT context
+                                ORDER BY import_id, type, id;''')
+                self.ambiguous = [tuple(row) for row in curs.fetchall()]
+                if self.ambiguous:
+                    l.warning('%d ambiguous nocity matches were not changed', len(self.ambiguous))
+                # An ambiguous address is near an existing object with its street and
+                # housenumber, so it is only reported and is neither output nor
+                # matched to a building
+                curs.execute('''UPDATE import_addresses
                                 SET pending_delete = TRUE
-                                FROM local_all
-                                WHERE import_addresses.tags -> 'addr:housenumber' = local_all.tags -> 'addr:housenumber'
-                                AND (import_addresses.tags -> 'addr:housenumber') IS NOT NULL
-                                AND import_addresses.tags -> 'addr:street' = local_all.tags -> 'addr:street'
-                                AND (import_addresses.tags -> 'addr:housenumber') IS NOT NULL
-                                AND local_all.type='N'
-                                AND ST_Intersects(ST_Buffer(geography(import_addresses.geom),%s)::geometry,local_all.geom)
-                                RETURNING local_all.id AS id,
-                                (import_addresses.tags || local_all.tags) AS merged_tags)
-                                INSERT INTO changed_nodes (id, version, tags, geom)
-                                SELECT nodes.id, nodes.version, to_delete.merged_tags, nodes.geom
-                                FROM to_delete JOIN nodes ON to_delete.id=nodes.id;''', (nocity,))
-                curs.execute('''WITH to_delete AS
-                                (UPDATE import_addresses
-                                SET pending_delete = TRUE
-                                FROM local_all
-                                WHERE import_addresses.tags -> 'addr:housenumber' = local_all.tags -> 'addr:housenumber'
-                                AND (import_addresses.tags -> 'addr:housenumber') IS NOT NULL
-                                AND import_addresses.tags -> 'addr:street' = local_all.tags -> 'addr:street'
-                                AND (import_addresses.tags -> 'addr:housenumber') IS NOT NULL
-                                AND local_all.type='W'
-                                AND ST_Intersects(ST_Buffer(geography(import_addresses.geom),%s)::geometry,local_all.geom)
-                                RETURNING local_all.id AS id,
-                                (import_addresses.tags || local_all.tags) AS merged_tags)
-                                INSERT INTO changed_ways (id, version, tags, nodes)
-                                SELECT ways.id, ways.version, to_delete.merged_tags, ways.nodes
-                                FROM to_delete JOIN ways ON to_delete.id=ways.id;''', (nocity,))
-                # no one likes relations, but we need to support them
-                curs.execute('''WITH to_delete AS
-                                (UPDATE import_addresses
-                                SET pending_delete = TRUE
-                                FROM local_all
-                                WHERE import_addresses.tags -> 'addr:housenumber' = local_all.tags -> 'addr:housenumber'
-                                AND (import_addresses.tags -> 'addr:housenumber') IS NOT NULL
-                                AND import_addresses.tags -> 'addr:street' = local_all.tags -> 'addr:street'
-                                AND (import_addresses.tags -> 'addr:housenumber') IS NOT NULL
-                                AND local_all.type='M'
-                                AND ST_Intersects(ST_Buffer(geography(import_addresses.geom),%s)::geometry,local_all.geom)
-                                RETURNING local_all.id AS id,
-                                (import_addresses.tags || local_all.tags) AS merged_tags)
-                                INSERT INTO changed_relations
-                                (id, version, tags, types, ids, roles)
-                                SELECT id, version, tags,
-                                array_agg(member_type) AS types,
-                                array_agg(member_id) AS ids,
-                                array_agg(member_role) AS roles
-                                FROM (SELECT relations.id, (relations.version + 1) AS version,
-                                merged_tags AS tags,
-                                member_type, member_id, member_role
-                                FROM to_delete JOIN relations
-                                ON to_delete.id=relations.id
-                                JOIN relation_members
-                                ON relations.id = relation_members.relation_id
-                                ORDER BY sequence_id ASC) AS combined_relations
-                                GROUP BY id,version,tags;''', (nocity,))
+                                FROM nocity_matches
+                                WHERE import_addresses.import_id = nocity_matches.import_id
+                                AND nocity_matches.ambiguous
+                                AND NOT nocity_matches.context;''')
 
             if building is not None:
-                degree_expand = building * self.scale
-                curs.execute('''CREATE TEMPORARY VIEW building_matches AS -- create this as a view since we'll be using it multiple times, and it's complex
-                                  SELECT possible_matches.import_id,
-                                    possible_matches.merged_tags,
-                                    possible_matches.id, possible_matches.type,
-                                    possible_matches.building_geom,
-                                    other_import_addresses.import_id AS other_id
-                                    FROM (
-                                      SELECT
-                                        import_id,
-                                        (import_addresses.tags || local_all.tags) AS merged_tags,
-                                        import_addresses.buffered_geom,
-                                        id, type,
-                                        ST_MakePolygon(local_all.geom) AS building_geom,
-                                        import_addresses.geom AS unbuffered_import_geom
-                                      FROM import_addresses JOIN local_all
-                                      ON import_addresses.buffered_geom && local_all.geom -- buildings aren't polygons yet so we can't use ST_Intersects, but this filter drastically brings down the matches that we need to MakePolygon on
-                                      WHERE local_all.tags ? 'building' -- well-formed buildings without addresses
-                                        AND (local_all.tags -> 'addr:housenumber') IS NULL
-                                        AND ST_IsClosed(local_all.geom)
-                                        AND type IN ('W','M')
-                                      OFFSET 0) --force the subquery to run without optimizing it out to avoid calling ST_IsValid on a MakePolygon of a non-closed linestring
-                                    AS possible_matches -- buildings that might match
-                                    LEFT JOIN import_addresses AS other_import_addresses -- this filters out buildings that would match multiple import addrs
-                                      ON possible_matches.import_id != other_import_addresses.import_id -- different point
-                                      AND ST_Expand(possible_matches.building_geom, %s) && other_import_addresses.geom -- pre-filter for speed
-                                      AND ST_DWithin(geography(possible_matches.building_geom), geography(other_import_addresses.geom), %s, FALSE) -- but still in the building.
-                                      -- the st_intersects produces a geometry_gist_joinsel notice
-                                    LEFT JOIN local_all AS other_osm_addr_points -- this filters out buildings that would match existing addrs
-                                      ON ST_Expand(possible_matches.building_geom, %s) && other_osm_addr_points.geom -- pre-filter
-                                      AND ST_DWithin(geography(possible_matches.building_geom),geography(other_osm_addr_points.geom), %s, FALSE) -- Same logic as filtering out multiple import addrs, except we don't have precomputed buffers
-                                      AND (other_osm_addr_points.tags -> 'addr:housenumber') IS NOT NULL -- there is an addr
-                                      AND other_osm_addr_points.id != possible_matches.id -- that isn't the same addr. note: this duplicates the above condition, but is faster
-                                      AND other_osm_addr_points.type = 'N' -- Only nodes
-                                    LEFT JOIN local_all AS other_osm_addr_areas -- this filters out import nodes that would be too close to another building
-                                      ON ST_Expand(possible_matches.building_geom, %s) && other_osm_addr_areas.geom -- pre-filter
-                                      AND ST_DWithin(geography(possible_matches.unbuffered_import_geom), geography(other_osm_addr_areas.geom), %s, FALSE)
-                                      AND other_osm_addr_points.id != possible_matches.id
-                                      AND other_osm_addr_areas.type IN ('W', 'M')
-                                    WHERE
-                                      ST_IsValid(possible_matches.building_geom) -- get rid of self-intersecting, etc
-                                      AND ST_Intersects(possible_matches.buffered_geom, building_geom) -- needs to be actually within, not just bbox overlap
-                                      AND other_import_addresses.import_id IS NULL -- find the ones that don't match to other import addrs
-                                      AND other_osm_addr_points.type IS NULL -- or to existing addr nodes
-                                      AND other_osm_addr_areas.type IS NULL; -- or to existing addr areas''', (degree_expand, building, degree_expand, building, degree_expand, building))
-                curs.execute('''WITH to_delete AS (
-                                  UPDATE import_addresses
-                                    SET pending_delete = TRUE
-                                  FROM building_matches
-                                    WHERE import_addresses.import_id = building_matches.import_id
-                                      AND building_matches.type = 'W'
-                                    RETURNING building_matches.id AS id, building_matches.merged_tags )
-                                INSERT INTO changed_ways (id, version, tags, nodes)
-                                  SELECT ways.id, ways.version, to_delete.merged_tags, ways.nodes
-                                    FROM to_delete JOIN ways ON to_delete.id=ways.id;''')
+                self._create_buildings(curs)
+                unambiguous = ''
+                if nocity is not None:
+                    unambiguous = '''AND NOT EXISTS (SELECT 1 FROM nocity_matches -- ambiguous addresses are only reported
+                                        WHERE nocity_matches.import_id = import_addresses.import_id
+                                          AND nocity_matches.ambiguous)'''
+                (near, near_params) = self._within('import_addresses', 'local_buildings', self.buffer)
+                (imports, imports_params) = self._within('local_buildings', 'other_import_addresses', building)
+                (points, points_params) = self._within('local_buildings', 'other_osm_addr_points', building)
+                curs.execute(self._staging_table('building_matches') + ''' AS
+                                  SELECT DISTINCT ON (import_addresses.import_id) -- one building per import addr
+                                    import_addresses.import_id,
+                                    (import_addresses.tags || local_buildings.tags) AS merged_tags,
+                                    local_buildings.id, local_buildings.type
+                                    FROM import_addresses JOIN local_buildings
+                                    ON ''' + near + '''
+                                    WHERE NOT import_addresses.context -- context addresses only block matches
+                                      ''' + unambiguous + '''
+                                      AND local_buildings.valid -- get rid of self-intersecting, etc
+                                      AND NOT EXISTS (SELECT 1 FROM import_addresses AS other_import_addresses -- this filters out buildings that would match multiple import addrs
+                                        WHERE other_import_addresses.import_id != import_addresses.import_id
+                                          AND ''' + imports + ''')
+                                      AND NOT EXISTS (SELECT 1 FROM local_all AS other_osm_addr_points -- this filters out buildings that would match existing addrs
+                                        WHERE other_osm_addr_points.type = 'N' -- Only nodes
+                                          AND (other_osm_addr_points.tags -> 'addr:housenumber') IS NOT NULL
+                                          AND ''' + points + ''')
+                                    ORDER BY import_addresses.import_id, local_buildings.type DESC, local_buildings.id;''',
+                             near_params + imports_params + points_params)
+                self._insert_changes(curs, 'building_matches', 'TRUE')
             curs.execute('''DELETE FROM import_addresses
                             WHERE pending_delete
                             RETURNING import_id;''')
             deleted |= set(id[0] for id in curs.fetchall())
             curs.execute('''ANALYZE import_addresses;''')
+            # Dropped explicitly rather than with ON COMMIT DROP, so the building
+            # tables never depend on how the transaction was begun
+            curs.execute('''DROP TABLE IF EXISTS %s;'''
+                         % ', '.join('%s.%s' % (self._functions, table) for table in
+                                     ('local_buildings', 'nocity_matches', 'building_matches')))
             curs.connection.commit()
 
             return deleted
@@ -350,13 +1280,121 @@ class OSMSource(object):
             if curs is not None:
                 curs.close()
 
-    def get_changed_nodes(self):
+    def _generate_changes_tiled(self, nocity, building, jobs):
+        '''
+        Splits the WKT area into tiles and runs generate_changes for each tile in
+        a pool of jobs processes, each with its own connection. Every import
+        address is matched in exactly one tile. A tile covers its cell grown by
+        the largest matching distance and, with building, by the extent of the
+        buildings it could match plus that distance, so a building crossing the
+        cell's edge is judged with all of its neighbours. The other addresses
+        within a tile, including context addresses such as those reused from an
+        incremental state, are loaded into it as context. Results are merged
+        in tile order, so a changed object matched from two tiles is taken from
+        the first, and the import address which changed it in the later tile is
+        kept in the output instead of being removed.
+        '''
+        margin = max(d for d in (self.buffer, nocity, building) if d is not None) * self.scale
+        (xmin, ymin, xmax, ymax) = self.extent
+        side = int(math.ceil(math.sqrt(4 * jobs)))
+        width = max((xmax - xmin) / side, 1e-9)
+        height = max((ymax - ymin) / side, 1e-9)
+
+        def cell(value, low, size):
+            return min(max(int(math.floor((value - low) / size)), 0), side - 1)
+
+        core = {}
+        others = {}
+        for address in self.get_import_addresses():
+            (x, y) = address[2]
+            core.setdefault((cell(x, xmin, width), cell(y, ymin, height)), []).append(address)
+        for address in self.get_import_addresses(context=True):
+            (x, y) = address[2]
+            others.setdefault((cell(x, xmin, width), cell(y, ymin, height)), []).append(address)
+
+        source_args = dict(self._connect_args, strippable=self.strippable,
+                           buffer=self.buffer, load_method=self.load_method,
+                           copy_batch=self.copy_batch, itersize=self.itersize,
+                           suffixes=self.suffixes, distance_method=self.distance_method,
+                           matchers=self.matchers, unlogged=self.unlogged,
+                           settings=self.settings)
+        tasks = []
+        for (i, j) in sorted(core):
+            bounds = (xmin + i * width - margin, ymin + j * height - margin,
+                      xmin + (i + 1) * width + margin, ymin + (j + 1) * height + margin)
+            if building is not None:
+                extent = self._building_extent(*bounds)
+                if extent is not None:
+                    bounds = (min(bounds[0], extent[0] - margin), min(bounds[1], extent[1] - margin),
+                              max(bounds[2], extent[2] + margin), max(bounds[3], extent[3] + margin))
+            context = []
+            for a in range(cell(bounds[0], xmin, width), cell(bounds[2], xmin, width) + 1):
+                for b in range(cell(bounds[1], ymin, height), cell(bounds[3], ymin, height) + 1):
+                    addresses = others.get((a, b), [])
+                    if (a, b) != (i, j):
+                        addresses = core.get((a, b), []) + addresses
+                    context.extend(address for address in addresses
+                                   if bounds[0] <= address[2][0] <= bounds[2]
+                                   and bounds[1] <= address[2][1] <= bounds[3])
+            wkt = self._tile_wkt(*bounds)
+            if wkt is None:
+                wkt = self.wkt
+            tasks.append((len(tasks), dict(source_args, wkt=wkt), nocity, building,
+                          core[(i, j)], context))
+        l.debug('Conflating %d tiles with %d jobs', len(tasks), jobs)
+
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_conflate_tile, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+        deleted = set()
+        kept = set()
+        nodes, ways, relations = {}, {}, {}
+        sources = {}
+        ambiguous = []
+        for (index, tile_deleted, tile_nodes, tile_ways, tile_relations, tile_sources,
+             tile_ambiguous) in sorted(results):
+            deleted |= tile_deleted
+            ambiguous.extend(tile_ambiguous)
+            for (key, import_id) in tile_sources.items():
+                sources.setdefault(key, import_id)
+            for (type, merged, objects) in (('node', nodes, tile_nodes), ('way', ways, tile_ways),
+                                            ('relation', relations, tile_relations)):
+                for obj in objects:
+                    if obj[0] in merged:
+                        import_id = tile_sources.get((type, obj[0]))
+                        l.warning('Tile %d also changed %s %d, keeping import address %s in the output',
+                                  index, type, obj[0], import_id)
+                        kept.add(import_id)
+                    else:
+                        merged[obj[0]] = obj
+        deleted -= kept
+        self.merge_changes(deleted, nodes.values(), ways.values(), relations.values(), sources)
+        self.ambiguous = sorted(ambiguous)
+        return deleted
+
+    def _building_extent(self, xmin, ymin, xmax, ymax):
+        '''
+        Returns the bounds of the unaddressed buildings in local_all touching the
+        given bounds as (xmin, ymin, xmax, ymax), or None if there are none
+        '''
         curs = None
         try:
             curs = self._conn.cursor()
-            curs.execute('''SELECT id, version, tags-%s, ST_X(geom) AS x, ST_Y(geom) AS y FROM changed_nodes;''',(self.strippable,))
+            curs.execute('''SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+                              FROM (SELECT ST_Extent(geom) AS extent
+                                FROM local_all
+                                WHERE type IN ('W', 'M')
+                                  AND tags ? 'building'
+                                  AND (tags -> 'addr:housenumber') IS NULL
+                                  AND geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)) AS buildings;''',
+                            (xmin, ymin, xmax, ymax))
+            extent = curs.fetchone()
             curs.connection.rollback()
-            return (curs.fetchall())
+            return None if extent[0] is None else extent
         except BaseException:
             if curs is not None:
                 curs.connection.rollback()
@@ -364,13 +1402,22 @@ class OSMSource(object):
         finally:
             if curs is not None:
                 curs.close()
-    def get_changed_ways(self):
+
+    def _tile_wkt(self, xmin, ymin, xmax, ymax):
+        '''
+        Returns the WKT for the part of self.wkt within the given bounds, or None
+        if they do not overlap
+        '''
         curs = None
         try:
             curs = self._conn.cursor()
-            curs.execute('''SELECT id, version, tags-%s, nodes FROM changed_ways;''',(self.strippable,))
+            curs.execute('''SELECT ST_AsText(tile.geom), ST_IsEmpty(tile.geom)
+                              FROM (SELECT ST_Intersection(ST_GeomFromText(%s, 4326),
+                                ST_MakeEnvelope(%s, %s, %s, %s, 4326)) AS geom) AS tile;''',
+                            (self.wkt, xmin, ymin, xmax, ymax))
+            (wkt, empty) = curs.fetchone()
             curs.connection.rollback()
-            return (curs.fetchall())
+            return None if empty else wkt
         except BaseException:
             if curs is not None:
                 curs.connection.rollback()
@@ -378,13 +1425,53 @@ class OSMSource(object):
         finally:
             if curs is not None:
                 curs.close()
-    def get_changed_relations(self):
+
+    def merge_changes(self, deleted, nodes, ways, relations, sources):
+        '''
+        Applies changes generated elsewhere, removing the deleted import addresses
+        and adding the changed objects. sources is as returned by
+        get_change_sources.
+        '''
+        curs = None
+        try:
+            curs = self._conn.cursor()
+            curs.execute('''DELETE FROM import_addresses
+                            WHERE import_id = ANY(%s);''', (list(deleted),))
+            curs.executemany('''INSERT INTO changed_nodes (id, version, tags, geom, import_id)
+                                VALUES (%s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s);''',
+                             [node + (sources.get(('node', node[0])),) for node in sorted(nodes)])
+            curs.executemany('''INSERT INTO changed_ways (id, version, tags, nodes, import_id)
+                                VALUES (%s, %s, %s, %s, %s);''',
+                             [way + (sources.get(('way', way[0])),) for way in sorted(ways)])
+            curs.executemany('''INSERT INTO changed_relations (id, version, tags, types, ids, roles, import_id)
+                                VALUES (%s, %s, %s, %s::character(1)[], %s, %s, %s);''',
+                             [relation + (sources.get(('relation', relation[0])),)
+                              for relation in sorted(relations)])
+            curs.execute('''ANALYZE import_addresses;''')
+            curs.connection.commit()
+        except BaseException:
+            if curs is not None:
+                curs.connection.rollback()
+            raise
+        finally:
+            if curs is not None:
+                curs.close()
+
+    def get_import_addresses(self, context=False):
+        '''
+        Returns the import addresses which have not been removed as tuples of
+        (id, tags, (x, y)). With context the context addresses are returned instead.
+        '''
         curs = None
         try:
             curs = self._conn.cursor()
-            curs.execute('''SELECT id, version, tags-%s, types, ids, roles FROM changed_relations;''',(self.strippable,))
+            curs.execute('''SELECT import_id, tags, ST_X(geom), ST_Y(geom)
+                            FROM import_addresses
+                            WHERE context = %s
+                            ORDER BY import_id;''', (context,))
+            addresses = [(id, tags, (x, y)) for (id, tags, x, y) in curs.fetchall()]
             curs.connection.rollback()
-            return (curs.fetchall())
+            return addresses
         except BaseException:
             if curs is not None:
                 curs.connection.rollback()
@@ -393,92 +1480,1455 @@ class OSMSource(object):
             if curs is not None:
                 curs.close()
 
-class ImportDocument(object):
-    def __init__(self, input):
-        self._parser = OSMParser(nodes_callback=self._parse_nodes)
-        self._nodes = deque()
-        l.debug('Parsing %s', input)
-        self._parser.parse(input)
+    def get_change_sources(self):
+        '''
+        Returns a dict of the import address that caused each change, keyed by
+        ('node', id), ('way', id) or ('relation', id)
+        '''
+        if not self.changes:
+            return {}
+        curs = None
+        try:
+            curs = self._conn.cursor()
+            curs.execute('''SELECT 'node', id, import_id FROM changed_nodes
+                            UNION ALL SELECT 'way', id, import_id FROM changed_ways
+                            UNION ALL SELECT 'relation', id, import_id FROM changed_relations;''')
+            sources = dict(((type, id), import_id) for (type, id, import_id) in curs.fetchall())
+            curs.connection.rollback()
+            return sources
+        except BaseException:
+            if curs is not None:
+                curs.connection.rollback()
+            raise
+        finally:
+            if curs is not None:
+                curs.close()
+
+    def get_versions(self, keys):
+        '''
+        Returns a dict of the current version of each object in keys, which are
+        ('node', id), ('way', id) or ('relation', id). Deleted objects are left out.
+        '''
+        curs = None
+        try:
+            curs = self._conn.cursor()
+            versions = {}
+            for (type, table) in (('node', 'nodes'), ('way', 'ways'), ('relation', 'relations')):
+                ids = sorted(id for (t, id) in keys if t == type)
+                if ids:
+                    curs.execute('''SELECT id, version FROM %s
+                                    WHERE id = ANY(%%s);''' % table, (ids,))
+                    versions.update(((type, id), version) for (id, version) in curs.fetchall())
+            curs.connection.rollback()
+            return versions
+        except BaseException:
+            if curs is not None:
+                curs.connection.rollback()
+            raise
+        finally:
+            if curs is not None:
+                curs.close()
+
+    def _stream(self, name, query, params):
+        '''
+        Yields the rows of query from a named server-side cursor, fetching
+        self.itersize rows per round trip so memory use does not depend on
+        the number of rows
+        '''
+        curs = None
+        try:
+            curs = self._conn.cursor(name)
+            curs.itersize = self.itersize
+            curs.execute(query, params)
+            for row in curs:
+                yield row
+        finally:
+            if curs is not None:
+                curs.close()
+            self._conn.rollback()
+
+    def get_changed_nodes(self):
+        return self._stream('changed_nodes_cursor',
+                            '''SELECT id, version, tags-%s, ST_X(geom) AS x, ST_Y(geom) AS y FROM changed_nodes;''',
+                            (self.strippable,))
+
+    def get_changed_ways(self):
+        return self._stream('changed_ways_cursor',
+                            '''SELECT id, version, tags-%s, nodes FROM changed_ways;''',
+                            (self.strippable,))
+
+    def get_changed_relations(self):
+        return self._stream('changed_relations_cursor',
+                            '''SELECT id, version, tags-%s, types, ids, roles FROM changed_relations;''',
+                            (self.strippable,))
+
+def _wkt_rings(wkt):
+    '''
+    Returns the rings of a POLYGON or MULTIPOLYGON WKT string as lists of (x, y)
+    '''
+    rings = [[tuple(float(c) for c in point.split()[:2]) for point in ring.split(',')]
+             for ring in re.findall(r'\(([^()]+)\)', wkt)]
+    if not rings:
+        raise ValueError('No polygon rings found in WKT')
+    return rings
+
+def _inside(xs, ys, rings):
+    '''
+    Returns a boolean array of which points are inside rings. The even-odd rule
+    is used, so holes and multiple polygons are handled.
+    '''
+    inside = numpy.zeros(len(xs), dtype=bool)
+    for ring in rings:
+        for ((x1, y1), (x2, y2)) in zip(ring[:-1], ring[1:]):
+            if y1 == y2:
+                continue
+            crosses = (y1 > ys) != (y2 > ys)
+            crosses &= xs < (x2 - x1) * (ys - y1) / (y2 - y1) + x1
+            inside ^= crosses
+    return inside
+
+def _crosses(xs, ys, edges):
+    '''
+    Returns whether the linestring through xs and ys crosses or touches any of
+    edges, an array of rows (ax, ay, bx, by)
+    '''
+    if len(xs) < 2:
+        return False
+    # Only edges overlapping the linestring's bounding box can cross it
+    (ax, ay, bx, by) = edges.T
+    edges = edges[(numpy.maximum(ax, bx) >= xs.min()) & (numpy.minimum(ax, bx) <= xs.max())
+                  & (numpy.maximum(ay, by) >= ys.min()) & (numpy.minimum(ay, by) <= ys.max())]
+    if not len(edges):
+        return False
+    (px, py, qx, qy) = [column[:, None] for column in _segments(numpy.column_stack([xs, ys])).T]
+    (ax, ay, bx, by) = edges.T
+    # Each segment's ends are on opposite sides of the edge or on it, and the reverse
+    sides = ((((bx - ax) * (py - ay) - (by - ay) * (px - ax))
+              * ((bx - ax) * (qy - ay) - (by - ay) * (qx - ax)) <= 0)
+             & (((qx - px) * (ay - py) - (qy - py) * (ax - px))
+                * ((qx - px) * (by - py) - (qy - py) * (bx - px)) <= 0))
+    # Rules out collinear segments which do not overlap
+    boxes = ((numpy.minimum(px, qx) <= numpy.maximum(ax, bx)) & (numpy.minimum(ax, bx) <= numpy.maximum(px, qx))
+             & (numpy.minimum(py, qy) <= numpy.maximum(ay, by)) & (numpy.minimum(ay, by) <= numpy.maximum(py, qy)))
+    return bool((sides & boxes).any())
+
+def _segments(coords):
+    '''
+    Returns the segments of a linestring as an array of rows (ax, ay, bx, by).
+    A single point becomes a zero length segment.
+    '''
+    if len(coords) == 1:
+        return numpy.hstack([coords, coords])
+    return numpy.hstack([coords[:-1], coords[1:]])
+
+def _distances(xs, ys, segments):
+    '''
+    Returns the distance from each point to the nearest of segments
+    '''
+    xs = numpy.asarray(xs, dtype=float)[:, None]
+    ys = numpy.asarray(ys, dtype=float)[:, None]
+    (ax, ay, bx, by) = segments.T
+    dx = bx - ax
+    dy = by - ay
+    length = dx * dx + dy * dy
+    t = ((xs - ax) * dx + (ys - ay) * dy) / numpy.where(length > 0, length, 1.0)
+    t = numpy.clip(t, 0.0, 1.0)
+    return numpy.hypot(ax + t * dx - xs, ay + t * dy - ys).min(axis=1)
+
+def _geometry_distances(x, y, geometries):
+    '''
+    Returns the distance from one point to each of a list of segment arrays,
+    calculated in a single vectorized pass
+    '''
+    starts = numpy.cumsum([0] + [len(segments) for segments in geometries[:-1]])
+    segments = numpy.vstack(geometries)
+    (ax, ay, bx, by) = segments.T
+    dx = bx - ax
+    dy = by - ay
+    length = dx * dx + dy * dy
+    t = numpy.clip(((x - ax) * dx + (y - ay) * dy) / numpy.where(length > 0, length, 1.0), 0.0, 1.0)
+    return numpy.minimum.reduceat(numpy.hypot(ax + t * dx - x, ay + t * dy - y), starts)
+
+def _polygon_distances(xs, ys, rings):
+    '''
+    Returns the distance from each point to a polygon given as a list of rings,
+    which is 0 for points inside it
+    '''
+    distances = _distances(xs, ys, numpy.vstack([_segments(ring) for ring in rings]))
+    distances[_inside(numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float), rings)] = 0.0
+    return distances
+
+class _Grid(object):
+    '''
+    A uniform grid spatial index of bounding boxes in projected metres
+    '''
+    def __init__(self, size):
+        self.size = float(size)
+        self._cells = {}
+
+    def _range(self, low, high):
+        return range(int(math.floor(low / self.size)), int(math.floor(high / self.size)) + 1)
+
+    def insert(self, item, xmin, ymin, xmax, ymax):
+        for i in self._range(xmin, xmax):
+            for j in self._range(ymin, ymax):
+                self._cells.setdefault((i, j), []).append(item)
+
+    def query(self, xmin, ymin, xmax, ymax):
+        found = set()
+        for i in self._range(xmin, xmax):
+            for j in self._range(ymin, ymax):
+                found.update(self._cells.get((i, j), ()))
+        return sorted(found)
+
+class MemorySource(object):
+    '''
+    Matches addresses against an OSM extract held in memory instead of a
+    pgsnapshot database. It has the same interface as OSMSource.
+
+    The extract is clipped to the WKT and indexed with a grid for spatial
+    matching and hash tables on the address tags. Distances are in meters on a
+    local equirectangular projection, which is close to the geography distances
+    used by OSMSource over a city-sized area.
+
+    XML extracts are read with their object versions. imposm does not report
+    versions when parsing PBF, so when changes are generated PBF extracts are
+    converted to XML with osmium as they are read.
+    '''
+    # Types of relation members as stored in relation_members
+    MEMBER_TYPES = {'node': 'N', 'way': 'W', 'relation': 'R'}
+
+    def __init__(self, extract, wkt, strippable, changes, buffer, workers=None, suffixes=None):
+        if numpy is None:
+            raise RuntimeError('numpy is required for the memory backend')
+        self.wkt = wkt
+        self.suffixes = suffixes or {}
+        self.strippable = set(strippable)
+        self.buffer = buffer
+        self._rings = _wkt_rings(wkt)
+        xs = [x for ring in self._rings for (x, y) in ring]
+        ys = [y for ring in self._rings for (x, y) in ring]
+        self.extent = (min(xs), min(ys), max(xs), max(ys))
+        self._origin = ((min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2)
+        self._scale = (111320.0 * math.cos(math.radians(self._origin[1])), 110574.0)
+        self._addresses = {}
+        self._changed_nodes = {}
+        self._changed_ways = {}
+        self._changed_relations = {}
+        self._sources = {}
+        self.ambiguous = []
+        self.changes = changes
+        self.read_extract(extract, workers)
+
+    def close(self):
+        pass
+
+    def _project(self, x, y):
+        return ((x - self._origin[0]) * self._scale[0], (y - self._origin[1]) * self._scale[1])
+
+    def read_extract(self, extract, workers=None):
+        '''
+        Reads the extract and builds the local objects and their indexes
+        '''
+        l.debug('Reading %s', extract)
+        self._coords = ([], [], [])
+        self._tagged_nodes = {}
+        self._ways = {}
+        self._relations = []
+        if extract.endswith('.pbf') and not self.changes:
+            self._versions = False
+            OSMParser(concurrency=workers, coords_callback=self._parse_coords,
+                      nodes_callback=self._parse_nodes, ways_callback=self._parse_ways,
+                      relations_callback=self._parse_relations).parse(extract)
+        elif extract.endswith('.pbf'):
+            self._versions = True
+            self._read_osmium(extract)
+        else:
+            self._versions = True
+            f = _open_input(extract)
+            try:
+                self._read_xml(f)
+            finally:
+                f.close()
+        self._build()
+        del self._coords, self._tagged_nodes, self._ways, self._relations
+
+    def _parse_coords(self, coords):
+        for (id, x, y) in coords:
+            self._coords[0].append(id)
+            self._coords[1].append(x)
+            self._coords[2].append(y)
 
     def _parse_nodes(self, nodes):
-        for node in nodes:
-            self._nodes.append(node)
+        for (id, tags, coords) in nodes:
+            if 'addr:housenumber' in tags:
+                self._tagged_nodes[id] = (None, tags)
 
-    def _serialize_node(self, f, node):
-        xmlnode = etree.Element('node', {'visible':'true', 'id':str(node[0]), 'lon':str(node[2][0]), 'lat':str(node[2][1])})
-        for (k,v) in node[1].items():
-            tag = etree.Element('tag',  {'k':k, 'v':v})
-            xmlnode.append(tag)
+    def _parse_ways(self, ways):
+        for (id, tags, refs) in ways:
+            self._ways[id] = (None, tags, refs)
 
-        f.write(etree.tostring(xmlnode, pretty_print=True))
+    def _parse_relations(self, relations):
+        for (id, tags, members) in relations:
+            if tags.get('type') == 'multipolygon':
+                self._relations.append((id, None, tags,
+                                        [(self.MEMBER_TYPES[type], ref, role) for (ref, type, role) in members]))
 
-    def _serialize_modify_node(self, f, node):
-        # A node is a tuple of (id, version, tags, x, y)
-        xmlnode = etree.Element('node', {'id':str(node[0]), 'version':str(node[1]),  'lon':str(node[3]), 'lat':str(node[4])})
-        for (k,v) in node[2].items():
-            tag = etree.Element('tag',  {'k':k, 'v':v})
-            xmlnode.append(tag)
+    def _read_osmium(self, extract):
+        '''
+        Reads a PBF extract with its versions by converting it to XML with osmium
+        '''
+        l.debug('Converting %s to XML with osmium', extract)
+        try:
+            process = subprocess.Popen(['osmium', 'cat', '-f', 'osm', '-o', '-', extract],
+                                       stdout=subprocess.PIPE)
+        except OSError as e:
+            raise RuntimeError('osmium is needed to read versions from %s: %s' % (extract, e))
+        try:
+            self._read_xml(process.stdout)
+        finally:
+            process.stdout.close()
+            status = process.wait()
+        if status != 0:
+            raise RuntimeError('osmium failed to read %s' % extract)
+
+    def _read_xml(self, f):
+        root = None
+        for (event, elem) in ElementTree.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end' or elem.tag not in ('node', 'way', 'relation'):
+                continue
+            id = int(elem.get('id'))
+            version = int(elem.get('version')) if elem.get('version') is not None else None
+            tags = dict((tag.get('k'), tag.get('v')) for tag in elem.iterfind('tag'))
+            if elem.tag == 'node':
+                self._parse_coords([(id, float(elem.get('lon')), float(elem.get('lat')))])
+                if 'addr:housenumber' in tags:
+                    self._tagged_nodes[id] = (version, tags)
+            elif elem.tag == 'way':
+                self._ways[id] = (version, tags, [int(nd.get('ref')) for nd in elem.iterfind('nd')])
+            elif tags.get('type') == 'multipolygon':
+                self._relations.append((id, version, tags,
+                                        [(self.MEMBER_TYPES[member.get('type')], int(member.get('ref')),
+                                          member.get('role')) for member in elem.iterfind('member')]))
+            # Processed elements are removed from the root so memory does not
+            # grow with the size of the extract
+            root.clear()
+
+    def _build(self):
+        (ids, lons, lats) = self._coords
+        lons = numpy.array(lons, dtype=float)
+        lats = numpy.array(lats, dtype=float)
+        inside = _inside(lons, lats, self._rings)
+        index = dict(zip(ids, range(len(ids))))
+        (xs, ys) = self._project(lons, lats)
+
+        # Each object is (type, id, version, tags, segments, payload)
+        objects = []
+        for (id, (version, tags)) in sorted(self._tagged_nodes.items()):
+            i = index.get(id)
+            if i is not None and inside[i]:
+                objects.append(('N', id, version, tags, _segments(numpy.array([[xs[i], ys[i]]])),
+                                (lons[i], lats[i])))
+        # Like ST_Intersects, ways crossing the WKT without a vertex inside it
+        # are also local
+        edges = numpy.vstack([_segments(numpy.array(ring, dtype=float)) for ring in self._rings])
+        local_ways = {}
+        for (id, (version, tags, refs)) in sorted(self._ways.items()):
+            positions = [index[ref] for ref in refs if ref in index]
+            if positions and (inside[positions].any() or _crosses(lons[positions], lats[positions], edges)):
+                coords = numpy.column_stack([xs[positions], ys[positions]])
+                local_ways[id] = (version, tags, refs, coords)
+                objects.append(('W', id, version, tags, _segments(coords), refs))
+        for (id, version, tags, members) in sorted(self._relations):
+            ways = [local_ways[ref][3] for (type, ref, role) in members
+                    if type == 'W' and ref in local_ways]
+            if ways:
+                objects.append(('M', id, version, tags, numpy.vstack([_segments(way) for way in ways]),
+                                members))
+
+        self._objects = objects
+        self._keys = set()
+        self._streets = {}
+        self._buildings = []
+        self._building_grid = _Grid(50)
+        node_positions = []
+        for (i, (type, id, version, tags, segments, payload)) in enumerate(objects):
+            key = _address_key(tags, self.suffixes)
+            if None not in key:
+                self._keys.add(key)
+            if key[0] is not None and key[1] is not None:
+                self._streets.setdefault(key[:2], []).append(i)
+            if type == 'N' and key[0] is not None:
+                node_positions.append(i)
+            # Only unaddressed closed ways and multipolygons can be matched to buildings
+            rings = None
+            if 'building' in tags and key[0] is None:
+                if type == 'W' and len(payload) >= 4 and payload[0] == payload[-1]:
+                    rings = [local_ways[id][3]]
+                elif type == 'M':
+                    rings = self._multipolygon_rings(payload, local_ways)
+            if rings:
+                points = numpy.vstack(rings)
+                self._building_grid.insert(len(self._buildings), points[:, 0].min(), points[:, 1].min(),
+                                           points[:, 0].max(), points[:, 1].max())
+                self._buildings.append((i, rings))
+        self._address_nodes = ([objects[i][1] for i in node_positions],
+                               numpy.array([objects[i][4][0, 0] for i in node_positions]),
+                               numpy.array([objects[i][4][0, 1] for i in node_positions]))
+        self._node_grid = _Grid(50)
+        for (i, position) in enumerate(node_positions):
+            (x, y) = objects[position][4][0, :2]
+            self._node_grid.insert(i, x, y, x, y)
+        l.debug('%d local objects, %d buildings', len(objects), len(self._buildings))
+
+    def _multipolygon_rings(self, members, local_ways):
+        '''
+        Returns the rings of a multipolygon whose way members are all closed
+        local ways, or None. Rings split across several ways are not assembled.
+        '''
+        rings = []
+        for (type, ref, role) in members:
+            if type != 'W':
+                continue
+            if ref not in local_ways:
+                return None
+            refs = local_ways[ref][2]
+            if len(refs) < 4 or refs[0] != refs[-1]:
+                return None
+            rings.append(local_ways[ref][3])
+        return rings or None
+
+    def load_addresses(self, addresses):
+        self.add_addresses(addresses)
+        self.index_addresses()
+
+    def add_addresses(self, addresses, context=False):
+        for (id, tags, (x, y)) in addresses:
+            self._addresses[id] = (tags, x, y, context)
+
+    def index_addresses(self):
+        l.info('Loaded %d addresses', len(self._addresses))
+
+    def find_duplicates(self):
+        l.debug('Finding duplicates')
+        deleted = set()
+        for (id, (tags, x, y, context)) in self._addresses.items():
+            key = _address_key(tags, self.suffixes)
+            if not context and None not in key and key in self._keys:
+                deleted.add(id)
+        for id in deleted:
+            del self._addresses[id]
+        self.prepare_matching()
+        return deleted
+
+    def prepare_matching(self):
+        self._import_ids = sorted(self._addresses)
+        (self._import_xs, self._import_ys) = self._project(
+            numpy.array([self._addresses[id][1] for id in self._import_ids], dtype=float),
+            numpy.array([self._addresses[id][2] for id in self._import_ids], dtype=float))
+        self._import_grid = _Grid(50)
+        for (i, (x, y)) in enumerate(zip(self._import_xs, self._import_ys)):
+            self._import_grid.insert(i, x, y, x, y)
+
+    def generate_changes(self, nocity=None, building=None, jobs=1):
+        if (nocity is not None or building is not None) and not self._versions:
+            raise ValueError('Changes can not be generated from an extract without versions')
+        pending = set()
+        ambiguous = set()
+        if nocity is not None:
+            ambiguous = self._match_nocity(nocity, pending)
+        if building is not None:
+            self._match_buildings(building, pending, ambiguous)
+        # Ambiguous addresses are only reported, not output
+        pending |= ambiguous
+        for id in pending:
+            del self._addresses[id]
+        return pending
+
+    def _change(self, obj, tags, import_id):
+        (type, id, version, old_tags, segments, payload) = obj
+        if type == 'N':
+            changed = self._changed_nodes
+            row = (id, version, tags, payload[0], payload[1])
+        elif type == 'W':
+            changed = self._changed_ways
+            row = (id, version, tags, payload)
+        else:
+            changed = self._changed_relations
+            row = (id, version + 1, tags, [m[0] for m in payload], [m[1] for m in payload],
+                   [m[2] for m in payload])
+        if id in changed:
+            l.debug('%s %d is already changed, skipping', type, id)
+            return False
+        changed[id] = row
+        self._sources[({'N': 'node', 'W': 'way', 'M': 'relation'}[type], id)] = import_id
+        return True
+
+    def _match_nocity(self, distance, pending):
+        # Like the SQL, every candidate is found first and ambiguous ones are
+        # reported instead of changed. Returns the ids of the ambiguous addresses.
+        candidates = []
+        for (i, id) in enumerate(self._import_ids):
+            (tags, x, y, context) = self._addresses[id]
+            key = _address_key(tags, self.suffixes)
+            if key[0] is None or key[1] is None:
+                continue
+            objects = [self._objects[o] for o in self._streets.get(key[:2], ())]
+            if not objects:
+                continue
+            distances = _geometry_distances(self._import_xs[i], self._import_ys[i],
+                                            [obj[4] for obj in objects])
+            candidates.extend((id, obj) for (obj, d) in zip(objects, distances) if d <= distance)
+
+        addresses = {}
+        objects = {}
+        ambiguous = set()
+        for (id, obj) in candidates:
+            addresses[id] = addresses.get(id, 0) + 1
+            objects[obj[:2]] = objects.get(obj[:2], 0) + 1
+        for (id, obj) in candidates:
+            # Context addresses only make other matches ambiguous
+            if self._addresses[id][3]:
+                continue
+            if addresses[id] > 1 or objects[obj[:2]] > 1:
+                self.ambiguous.append((id, obj[0], obj[1]))
+                ambiguous.add(id)
+                continue
+            merged = dict(self._addresses[id][0])
+            merged.update(obj[3])
+            if self._change(obj, merged, id):
+                pending.add(id)
+        self.ambiguous.sort()
+        if self.ambiguous:
+            l.warning('%d ambiguous nocity matches were not changed', len(self.ambiguous))
+        return ambiguous
+
+    def _match_buildings(self, distance, pending, ambiguous=()):
+        # Like the SQL, each import address matches at most one building, taking
+        # ways before multipolygons and then the lowest id. Ambiguous nocity
+        # addresses are skipped.
+        neighbours = {}
+        for (i, id) in enumerate(self._import_ids):
+            (tags, x, y, context) = self._addresses[id]
+            if context or id in ambiguous:
+                continue
+            (px, py) = (self._import_xs[i], self._import_ys[i])
+            matches = []
+            for b in self._building_grid.query(px - self.buffer, py - self.buffer,
+                                               px + self.buffer, py + self.buffer):
+                (position, rings) = self._buildings[b]
+                if _polygon_distances([px], [py], rings)[0] > self.buffer:
+                    continue
+                if b not in neighbours:
+                    neighbours[b] = self._building_neighbours(rings, distance)
+                (imports, nodes) = neighbours[b]
+                if nodes or imports - set([id]):
+                    continue
+                obj = self._objects[position]
+                matches.append((obj[0] != 'W', obj[1], obj))
+            if matches:
+                obj = min(matches)[2]
+                merged = dict(tags)
+                merged.update(obj[3])
+                if self._change(obj, merged, id):
+                    pending.add(id)
+
+    def _building_neighbours(self, rings, distance):
+        '''
+        Returns the ids of import addresses within distance of a building and
+        whether there are addressed nodes within distance of it
+        '''
+        points = numpy.vstack(rings)
+        (xmin, ymin) = points.min(axis=0) - distance
+        (xmax, ymax) = points.max(axis=0) + distance
+        candidates = self._import_grid.query(xmin, ymin, xmax, ymax)
+        imports = set()
+        if candidates:
+            near = _polygon_distances(self._import_xs[candidates], self._import_ys[candidates], rings) <= distance
+            imports = set(self._import_ids[c] for (c, n) in zip(candidates, near) if n)
+        nodes = False
+        candidates = self._node_grid.query(xmin, ymin, xmax, ymax)
+        if candidates:
+            nodes = bool((_polygon_distances(self._address_nodes[1][candidates],
+                                             self._address_nodes[2][candidates], rings) <= distance).any())
+        return (imports, nodes)
+
+    def get_change_sources(self):
+        return dict(self._sources)
+
+    def get_versions(self, keys):
+        # Only objects in the clipped extract are known, others count as deleted
+        types = {'N': 'node', 'W': 'way', 'M': 'relation'}
+        versions = dict(((types[obj[0]], obj[1]), obj[2]) for obj in self._objects)
+        return dict((key, versions[key]) for key in keys if key in versions)
+
+    def _strip(self, tags):
+        return dict((k, v) for (k, v) in tags.items() if k not in self.strippable)
+
+    def get_changed_nodes(self):
+        return [(id, version, self._strip(tags), x, y)
+                for (id, version, tags, x, y) in sorted(self._changed_nodes.values())]
+
+    def get_changed_ways(self):
+        return [(id, version, self._strip(tags), nodes)
+                for (id, version, tags, nodes) in sorted(self._changed_ways.values())]
+
+    def get_changed_relations(self):
+        return [(id, version, self._strip(tags), types, ids, roles)
+                for (id, version, tags, types, ids, roles) in sorted(self._changed_relations.values())]
 
-        f.write(etree.tostring(xmlnode, pretty_print=True))
+# Escapes for XML attribute values, matching what lxml produces
+_ATTRIBUTE_ESCAPES = {ord(u'&'): u'&amp;', ord(u'<'): u'&lt;', ord(u'>'): u'&gt;',
+                      ord(u'"'): u'&quot;', ord(u'\n'): u'&#10;', ord(u'\r'): u'&#13;',
+                      ord(u'\t'): u'&#9;'}
+_MEMBER_TYPES = {'N': u'node', 'W': u'way', 'R': u'relation'}
 
-    def _serialize_modify_way(self, f, way):
+def _attribute(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return value.translate(_ATTRIBUTE_ESCAPES)
+
+class OSMWriter(object):
+    '''
+    Writes OSM XML elements to a file as escaped strings, buffering the output.
+    The output is the same as pretty printing the elements with lxml, with
+    non-ASCII characters written as character references.
+    '''
+    def __init__(self, f, buffer_size=65536):
+        self._f = f
+        self._buffer = []
+        self._buffered = 0
+        self.buffer_size = buffer_size
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self._f.write(u''.join(self._buffer).encode('ascii', 'xmlcharrefreplace'))
+        self._buffer = []
+        self._buffered = 0
+
+    def _tags(self, parts, tags):
+        for (k, v) in tags.items():
+            parts.append(u'  <tag k="%s" v="%s"/>\n' % (_attribute(k), _attribute(v)))
+
+    def _end(self, parts, name):
+        if len(parts) == 1:
+            parts[0] = parts[0][:-2] + u'/>\n'
+        else:
+            parts.append(u'</%s>\n' % name)
+        self.write(u''.join(parts))
+
+    def node(self, id, tags, x, y):
+        parts = [u'<node visible="true" id="%s" lon="%s" lat="%s">\n' % (id, str(x), str(y))]
+        self._tags(parts, tags)
+        self._end(parts, u'node')
+
+    def modify_node(self, node):
+        # A node is a tuple of (id, version, tags, x, y)
+        parts = [u'<node id="%s" version="%s" lon="%s" lat="%s">\n' % (node[0], node[1], str(node[3]), str(node[4]))]
+        self._tags(parts, node[2])
+        self._end(parts, u'node')
+
+    def modify_way(self, way):
         # A way is a tuple of (id, version, tags, nodes)
-        xmlway = etree.Element('way', {'id':str(way[0]), 'version':str(way[1])})
+        parts = [u'<way id="%s" version="%s">\n' % (way[0], way[1])]
         for ref in way[3]:
-            nd = etree.Element('nd', {'ref':str(ref)})
-            xmlway.append(nd)
-        for (k,v) in way[2].items():
-            tag = etree.Element('tag',  {'k':k, 'v':v})
-            xmlway.append(tag)
+            parts.append(u'  <nd ref="%s"/>\n' % ref)
+        self._tags(parts, way[2])
+        self._end(parts, u'way')
 
-        f.write(etree.tostring(xmlway, pretty_print=True))
-
-    def _serialize_modify_relation(self, f, relation):
+    def modify_relation(self, relation):
         # A relation is a tuple of (id, version, tags, types, ids, roles)
-        xmlrelation = etree.Element('relation', {'id':str(relation[0]), 'version':str(relation[1])})
-        typelookup = {'N':'node', 'W':'way', 'R':'relation'}
-        for i in xrange(0, len(relation[3])):
-            member = etree.Element('member', {'type':typelookup[str(relation[3][i])], 'ref':str(relation[4][i]), 'role':str(relation[5][i])})
-            xmlrelation.append(member)
-        for (k,v) in relation[2].items():
-            tag = etree.Element('tag',  {'k':k, 'v':v})
-            xmlrelation.append(tag)
+        parts = [u'<relation id="%s" version="%s">\n' % (relation[0], relation[1])]
+        for (type, ref, role) in zip(relation[3], relation[4], relation[5]):
+            parts.append(u'  <member type="%s" ref="%s" role="%s"/>\n'
+                         % (_MEMBER_TYPES[str(type)], ref, _attribute(role)))
+        self._tags(parts, relation[2])
+        self._end(parts, u'relation')
+
+class AddressStore(object):
+    '''
+    Holds parsed import addresses in typed arrays instead of tuples and dicts.
+    Ids and coordinates are kept in arrays, and tags as a flat array of key and
+    value codes, with each distinct string stored once. Removing addresses sets
+    a mask instead of copying the store.
+
+    Iterating gives the remaining addresses as (id, tags, (x, y)).
+    '''
+    def __init__(self):
+        self._ids = array('l')
+        self._xs = array('d')
+        self._ys = array('d')
+        # Address i has the key and value codes _tags[_offsets[i]:_offsets[i + 1]]
+        self._offsets = array('l', [0])
+        self._tags = array('i')
+        self._strings = []
+        self._codes = {}
+        self._removed = bytearray()
+        self._count = 0
+
+    def _code(self, string):
+        code = self._codes.get(string)
+        if code is None:
+            code = self._codes[string] = len(self._strings)
+            self._strings.append(string)
+        return code
+
+    def extend(self, nodes):
+        for (id, tags, (x, y)) in nodes:
+            self._ids.append(id)
+            self._xs.append(x)
+            self._ys.append(y)
+            for (k, v) in tags.items():
+                self._tags.append(self._code(k))
+                self._tags.append(self._code(v))
+            self._offsets.append(len(self._tags))
+            self._removed.append(0)
+            self._count += 1
 
-        f.write(etree.tostring(xmlrelation, pretty_print=True))
+    def remove(self, ids):
+        for (i, id) in enumerate(self._ids):
+            if id in ids and not self._removed[i]:
+                self._removed[i] = 1
+                self._count -= 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        strings = self._strings
+        tags = self._tags
+        offsets = self._offsets
+        for i in range(len(self._ids)):
+            if self._removed[i]:
+                continue
+            codes = tags[offsets[i]:offsets[i + 1]]
+            yield (self._ids[i],
+                   dict((strings[codes[j]], strings[codes[j + 1]]) for j in range(0, len(codes), 2)),
+                   (self._xs[i], self._ys[i]))
+
+class IncrementalState(object):
+    '''
+    The outcome of each input address in a previous run, so that a run over an
+    updated input only has to match addresses which are new or modified.
+
+    Outcomes are duplicate, changed, ambiguous or emitted. Only duplicates and
+    changes are reused: emitted and ambiguous addresses are matched again, as
+    OSM may have gained their address since. Changed addresses also keep the
+    objects they modified so the OSC can still be written in full, and are
+    matched again if one of those objects has since been modified.
+
+    run describes what the outcomes depend on besides the address itself: the
+    area and the matching options. A state saved by a run with a different
+    description is ignored.
+    '''
+    VERSION = 3
+    # Outcomes which are reused
+    REUSABLE = ('duplicate', 'changed')
+
+    def __init__(self, path, run=None):
+        self.path = path
+        # Compared after a round trip through JSON, as it is when loaded
+        self.run = json.loads(json.dumps(run))
+        self._previous = {}
+        self._digests = {}
+        self._reused = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('version') != self.VERSION:
+                l.warning('Ignoring state file %s with version %s', path, state.get('version'))
+            elif state.get('run') != self.run:
+                l.warning('Ignoring state file %s from a run with a different area or options', path)
+            else:
+                self._previous = dict((int(id), record) for (id, record) in state['addresses'].items())
+        l.debug('%d addresses in previous state', len(self._previous))
+
+    @staticmethod
+    def digest(tags, x, y):
+        return hashlib.md5(json.dumps([sorted(tags.items()), x, y]).encode('utf-8')).hexdigest()
+
+    def previous_outcome(self, id, tags, x, y):
+        '''
+        Returns the previous outcome of an address, or None if it is new, has
+        been modified since the previous run or has to be matched again
+        '''
+        digest = self.digest(tags, x, y)
+        self._digests[id] = digest
+        record = self._previous.get(id)
+        if record is None or record['digest'] != digest or record['outcome'] not in self.REUSABLE:
+            return None
+        self._reused[id] = record
+        return record['outcome']
+
+    def check_changes(self, existing):
+        '''
+        Stops reusing the changed addresses with a changed object whose version
+        in existing differs from the one it was changed from, returning their ids
+        '''
+        keys = set((type, row[0]) for record in self._reused.values()
+                   for (type, row) in record.get('changes', []))
+        versions = existing.get_versions(keys) if keys else {}
+        stale = set()
+        for (id, record) in self._reused.items():
+            for (type, row) in record.get('changes', []):
+                # Changed relations are written with their version incremented
+                version = row[1] - 1 if type == 'relation' else row[1]
+                if versions.get((type, row[0])) != version:
+                    stale.add(id)
+        for id in stale:
+            del self._reused[id]
+        return stale
+
+    def carried_changes(self):
+        '''
+        Returns the changes made for reused addresses as dicts of rows by id,
+        keyed by node, way and relation
+        '''
+        changes = {'node': {}, 'way': {}, 'relation': {}}
+        for (id, record) in sorted(self._reused.items()):
+            for (type, row) in record.get('changes', []):
+                changes[type].setdefault(row[0], row)
+        return changes
+
+    def save(self, duplicates, changed, ambiguous, sources, rows):
+        '''
+        Writes the outcome of every address in this run. changed includes the
+        ambiguous addresses. sources is as returned by get_change_sources and
+        rows holds the changed objects with the same keys.
+        '''
+        produced = {}
+        for (key, import_id) in sources.items():
+            if key in rows:
+                produced.setdefault(import_id, []).append([key[0], rows[key]])
+        addresses = {}
+        for (id, digest) in self._digests.items():
+            if id in self._reused:
+                addresses[str(id)] = self._reused[id]
+            elif id in duplicates:
+                addresses[str(id)] = {'digest': digest, 'outcome': 'duplicate'}
+            elif id in ambiguous:
+                addresses[str(id)] = {'digest': digest, 'outcome': 'ambiguous'}
+            elif id in changed:
+                addresses[str(id)] = {'digest': digest, 'outcome': 'changed',
+                                      'changes': produced.get(id, [])}
+            else:
+                addresses[str(id)] = {'digest': digest, 'outcome': 'emitted'}
+        l.debug('Saving state of %d addresses, %d reused', len(addresses), len(self._reused))
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'version': self.VERSION, 'run': self.run, 'addresses': addresses}, f)
+        os.rename(self.path + '.tmp', self.path)
+
+class ImportDocument(object):
+    def __init__(self, input, existing=None, workers=None, state=None, check=None):
+        '''
+        Parses the nodes in input. If existing is given the document is streamed:
+        nodes are loaded into existing as they are parsed, only the ids of removed
+        nodes are kept and output_osm makes a second pass over input.
+
+        workers is the number of processes used to parse PBF input. If state is
+        an IncrementalState, duplicates and changed addresses unchanged since the
+        previous run reuse their previous outcome. Changed ones are only loaded
+        as context for matching, once their changes are checked against existing.
+
+        check is called as each batch of nodes is parsed, and can raise to stop
+        parsing.
+        '''
+        self.input = input
+        self._check = check
+        self.workers = workers
+        self._existing = existing
+        self._state = state
+        self._removed = set()
+        self._reused = set()
+        self._carried = []
+        self._duplicates = set()
+        self._changed = set()
+        if existing is None:
+            self._nodes = AddressStore()
+            parse_input(input, self._parse_nodes, workers)
+        else:
+            self._nodes = None
+            parse_input(input, self._stream_nodes, workers)
+
+    def _reuse(self, nodes):
+        '''
+        Applies the previous outcome of unchanged addresses and returns the nodes
+        which are still to be output
+        '''
+        if self._state is None:
+            return nodes
+        kept = []
+        for node in nodes:
+            (id, tags, (x, y)) = node
+            outcome = self._state.previous_outcome(id, tags, x, y)
+            if outcome is None:
+                kept.append(node)
+                continue
+            self._reused.add(id)
+            self._removed.add(id)
+            if outcome == 'changed':
+                self._carried.append(node)
+        return kept
+
+    def _parse_nodes(self, nodes):
+        if self._check is not None:
+            self._check()
+        self._nodes.extend(self._reuse(nodes))
+
+    def _stream_nodes(self, nodes):
+        if self._check is not None:
+            self._check()
+        self._existing.add_addresses(self._reuse(nodes))
+
+    def _remove(self, ids):
+        if self._nodes is None:
+            self._removed |= ids
+        else:
+            self._nodes.remove(ids)
+
+    def _check_carried(self, existing):
+        '''
+        Loads the reused changed addresses into existing as context. Those whose
+        changed objects have been modified since the previous run are loaded to
+        be matched again instead.
+        '''
+        stale = self._state.check_changes(existing)
+        if stale:
+            l.info('Matching %d addresses again as objects they changed have been modified', len(stale))
+            self._reused -= stale
+            fresh = [node for node in self._carried if node[0] in stale]
+            if self._nodes is None:
+                self._removed -= stale
+            else:
+                self._nodes.extend(fresh)
+            existing.add_addresses(fresh)
+        existing.add_addresses([node for node in self._carried if node[0] not in stale], context=True)
+        self._carried = []
 
     def remove_existing(self, existing):
-        existing.load_addresses(self._nodes)
+        if self._nodes is not None:
+            existing.add_addresses(self._nodes)
+        if self._state is not None:
+            self._check_carried(existing)
+        if self._reused:
+            l.info('Reusing previous outcome of %d unchanged addresses', len(self._reused))
+        existing.index_addresses()
         duplicates = existing.find_duplicates()
         l.debug('Removing duplicates')
-        self._nodes = filter(lambda node: node[0] not in duplicates, self._nodes)
+        self._remove(duplicates)
+        self._duplicates = duplicates
         l.debug('%d duplicates removed', len(duplicates))
 
     def remove_changed(self, existing, **kwargs):
         duplicates = existing.generate_changes(**kwargs)
         l.debug('Removing changed')
-        self._nodes = filter(lambda node: node[0] not in duplicates, self._nodes)
+        self._remove(duplicates)
+        self._changed = duplicates
         l.debug('%d changed removed', len(duplicates))
 
+    def save_state(self, existing):
+        '''
+        Saves the outcome of this run to the incremental state
+        '''
+        sources = existing.get_change_sources()
+        rows = {}
+        if sources:
+            for (type, objects) in (('node', existing.get_changed_nodes()),
+                                    ('way', existing.get_changed_ways()),
+                                    ('relation', existing.get_changed_relations())):
+                for row in objects:
+                    rows[(type, row[0])] = row
+        self._state.save(self._duplicates, self._changed,
+                         set(import_id for (import_id, type, id) in existing.ambiguous), sources, rows)
+
     def output_osm(self, f):
-        f.write('<?xml version="1.0"?>\n<osm version="0.6" upload="false" generator="addressmerge">\n')
-        for node in self._nodes:
-            self._serialize_node(f, node)
+        writer = OSMWriter(f)
+        writer.write(u'<?xml version="1.0"?>\n<osm version="0.6" upload="false" generator="addressmerge">\n')
+        if self._nodes is None:
+            def write_nodes(nodes):
+                for (id, tags, (x, y)) in nodes:
+                    if id not in self._removed:
+                        writer.node(id, tags, x, y)
+            l.debug('Re-reading %s for output', self.input)
+            parse_input(self.input, write_nodes, self.workers)
+        else:
+            for (id, tags, (x, y)) in self._nodes:
+                writer.node(id, tags, x, y)
 
-        f.write('</osm>\n')
+        writer.write(u'</osm>\n')
+        writer.flush()
 
     def output_osc(self, existing, f):
-        f.write('<?xml version="1.0"?>\n<osmChange version="0.6" upload="false" generator="addressmerge">\n')
-        f.write('<modify>\n')
+        writer = OSMWriter(f)
+        writer.write(u'<?xml version="1.0"?>\n<osmChange version="0.6" upload="false" generator="addressmerge">\n')
+        writer.write(u'<modify>\n')
+        if self._state is not None:
+            carried = self._state.carried_changes()
+        else:
+            carried = {'node': {}, 'way': {}, 'relation': {}}
         for node in existing.get_changed_nodes():
-            self._serialize_modify_node(f, node)
+            carried['node'].pop(node[0], None)
+            writer.modify_node(node)
+        for (id, node) in sorted(carried['node'].items()):
+            writer.modify_node(node)
 
         for way in existing.get_changed_ways():
-            self._serialize_modify_way(f, way)
+            carried['way'].pop(way[0], None)
+            writer.modify_way(way)
+        for (id, way) in sorted(carried['way'].items()):
+            writer.modify_way(way)
 
         for relation in existing.get_changed_relations():
-            self._serialize_modify_relation(f, relation)
-        f.write('</modify>\n')
-        f.write('</osmChange>\n')
+            carried['relation'].pop(relation[0], None)
+            writer.modify_relation(relation)
+        for (id, relation) in sorted(carried['relation'].items()):
+            writer.modify_relation(relation)
+        writer.write(u'</modify>\n')
+        writer.write(u'</osmChange>\n')
+        writer.flush()
+
+class _Cancelled(Exception):
+    pass
+
+class _Handoff(object):
+    '''
+    Stands in for the source while it is being created so that the input can
+    be parsed at the same time. Streamed addresses are spooled to a temporary
+    file until attach is called, then passed to the main thread through a
+    bounded queue.
+    '''
+    def __init__(self, queue_size=16):
+        self._lock = threading.Lock()
+        self._spool = tempfile.TemporaryFile()
+        self._spooled = 0
+        self._queue = queue.Queue(queue_size)
+        self._attached = False
+        self._cancelled = threading.Event()
+        self._failed = False
+        self._conn = None
+
+    def add_addresses(self, addresses, context=False):
+        '''
+        Called from the parsing thread
+        '''
+        batch = (list(addresses), context)
+        with self._lock:
+            if not self._attached:
+                if self._cancelled.is_set():
+                    raise _Cancelled()
+                pickle.dump(batch, self._spool, pickle.HIGHEST_PROTOCOL)
+                self._spooled += 1
+                return
+        self._put(batch)
+
+    def _put(self, item):
+        # Waits while the queue is full, giving up if the main thread has failed
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled()
+
+    def finish(self):
+        '''
+        Called from the parsing thread once it has stopped, successfully or not
+        '''
+        try:
+            self._put(None)
+        except _Cancelled:
+            pass
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check(self):
+        '''
+        Called from the parsing thread, raising _Cancelled once the main thread
+        has failed
+        '''
+        if self._cancelled.is_set():
+            raise _Cancelled()
+
+    def watch(self, conn):
+        '''
+        Called from the main thread with the connection of the source being
+        created, which is cancelled if parsing fails
+        '''
+        with self._lock:
+            self._conn = conn
+            failed = self._failed
+        if failed:
+            raise _Cancelled()
+
+    def fail(self):
+        '''
+        Called from the parsing thread when it fails, cancelling the query the
+        source is running
+        '''
+        with self._lock:
+            self._failed = True
+            conn = self._conn
+        if conn is not None:
+            l.debug('Cancelling table creation')
+            conn.cancel()
+
+    def attach(self, source):
+        '''
+        Loads the spooled addresses into source, then the rest as they are
+        parsed. Returns once parsing has finished.
+        '''
+        with self._lock:
+            self._attached = True
+        l.debug('Loading %d batches parsed while creating tables', self._spooled)
+        self._spool.seek(0)
+        for i in range(self._spooled):
+            (addresses, context) = pickle.load(self._spool)
+            source.add_addresses(addresses, context)
+        self._spool.close()
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            source.add_addresses(*batch)
+
+def prepare_concurrently(create_source, input, stream=False, workers=None, state=None):
+    '''
+    Calls create_source while input is parsed into an ImportDocument in another
+    thread, returning (source, document). With stream the addresses are loaded
+    into the source as they are parsed, spooling those parsed before it exists.
+
+    create_source is called with a function to pass its database connection
+    to, if it has one. If creating the source fails parsing is stopped, and if
+    parsing fails the source's current query is cancelled and the source is
+    closed. In both cases the error is raised.
+    '''
+    handoff = _Handoff()
+    result = {}
+    def parse():
+        try:
+            result['document'] = ImportDocument(input, existing=handoff if stream else None,
+                                                workers=workers, state=state, check=handoff.check)
+        except BaseException as e:
+            result['error'] = e
+            # Stopped because the main thread failed, which is already handled
+            if not isinstance(e, _Cancelled):
+                handoff.fail()
+        finally:
+            handoff.finish()
+    thread = threading.Thread(target=parse, name='parse')
+    thread.daemon = True
+    thread.start()
+
+    source = None
+    try:
+        source = create_source(handoff.watch)
+        handoff.attach(source)
+    except BaseException:
+        handoff.cancel()
+        thread.join()
+        if source is not None:
+            source.close()
+        # A parse error is what caused the source's query to be cancelled
+        if 'error' in result and not isinstance(result['error'], _Cancelled):
+            raise result['error']
+        raise
+    thread.join()
+    if 'error' in result:
+        source.close()
+        raise result['error']
+    result['document']._existing = source
+    return (source, result['document'])
+
+def conflate(job, wkt, create_source, metrics):
+    '''
+    Runs one import as described by job, which has the options in
+    BATCH_DEFAULTS and the paths in BATCH_PATHS, and returns the number of
+    duplicate, changed and ambiguous addresses. This is used both for a single
+    run and for each batch job.
+
+    create_source is called with the tags to strip, the street suffixes and a
+    function to pass its connection to, and returns the source to match
+    against. It is called while the input is parsed, and the source is closed
+    before returning.
+    '''
+    striplist = set(['created_by', 'odbl', 'odbl:note'])
+    if job['remove_tags'] is not None:
+        with open(job['remove_tags']) as f:
+            striplist |= set(line.strip() for line in f)
+    suffixes = None
+    if job['street_suffixes'] is not None:
+        with open(job['street_suffixes']) as f:
+            suffixes = read_street_suffixes(f)
+
+    state = None
+    if job['incremental'] is not None:
+        # Previous outcomes are only reused for the same area and options
+        run = {'backend': job['backend'], 'wkt': wkt, 'nocity': job['nocity'], 'building': job['building'],
+               'buffer': job['buffer'], 'distance_method': job['distance_method'],
+               'suffixes': sorted((suffixes or {}).items()), 'remove_tags': sorted(striplist)}
+        state = IncrementalState(job['incremental'], run)
+
+    # Outputs are opened before processing so a bad path is found right away
+    outputs = []
+    try:
+        output = _open_output(job['output'])
+        outputs.append(output)
+        if job['osc'] is not None:
+            osc = _open_output(job['osc'])
+            outputs.append(osc)
+        if job['ambiguous'] is not None:
+            ambiguous = _open_output(job['ambiguous'])
+            outputs.append(ambiguous)
+
+        # Tables are created while the input is parsed in another thread
+        with metrics.stage('create_tables_and_parse'):
+            (existing, document) = prepare_concurrently(
+                lambda connected: create_source(list(striplist), suffixes, connected),
+                job['input'], stream=job['stream'], workers=job['parser_workers'], state=state)
+
+        try:
+            with metrics.stage('remove_existing'):
+                document.remove_existing(existing)
+            with metrics.stage('remove_changed'):
+                document.remove_changed(existing, nocity=job['nocity'], building=job['building'],
+                                        jobs=job['jobs'])
+            if job['ambiguous'] is not None:
+                for (import_id, type, id) in existing.ambiguous:
+                    ambiguous.write(('%d\t%s\t%d\n' % (import_id, type, id)).encode('utf-8'))
+                outputs.remove(ambiguous)
+                ambiguous.close()
+            with metrics.stage('output_osm'):
+                document.output_osm(output)
+                outputs.remove(output)
+                output.close()
+            if job['osc'] is not None:
+                with metrics.stage('output_osc'):
+                    document.output_osc(existing, osc)
+                    outputs.remove(osc)
+                    osc.close()
+            if state is not None:
+                document.save_state(existing)
+        finally:
+            # Drops the run's schema with --unlogged
+            existing.close()
+    finally:
+        _close_outputs(outputs)
+    return {'duplicates': len(document._duplicates), 'changed': len(document._changed),
+            'ambiguous': len(existing.ambiguous)}
+
+# Options a batch job can set, and their defaults
+BATCH_DEFAULTS = {'name': None, 'osc': None, 'ambiguous': None, 'nocity': None, 'building': None,
+                  'buffer': 0.5, 'distance_method': 'buffer', 'load_method': 'copy',
+                  'jobs': 1, 'stream': False, 'parser_workers': None, 'incremental': None,
+                  'remove_tags': None, 'street_suffixes': None,
+                  'unlogged': False, 'settings': None}
+# Options which are paths relative to the manifest
+BATCH_PATHS = ('input', 'wkt', 'output', 'osc', 'ambiguous', 'incremental', 'remove_tags', 'street_suffixes')
+
+def read_manifest(f):
+    '''
+    Reads a batch manifest. This is a JSON object with a list of jobs and
+    optional defaults for them. Each job needs input, wkt and output and can set
+    any of BATCH_DEFAULTS. Paths are relative to the manifest.
+    '''
+    manifest = json.load(f)
+    base = os.path.dirname(getattr(f, 'name', ''))
+    jobs = []
+    for (i, options) in enumerate(manifest['jobs']):
+        job = dict(BATCH_DEFAULTS)
+        job.update(manifest.get('defaults', {}))
+        job.update(options)
+        for key in ('input', 'wkt', 'output'):
+            if job.get(key) is None:
+                raise ValueError('Job %d has no %s' % (i, key))
+        if job['osc'] is None and (job['nocity'] is not None or job['building'] is not None):
+            raise ValueError('Job %d uses nocity or building without an osc' % i)
+        unknown = set(job) - set(BATCH_DEFAULTS) - set(BATCH_PATHS)
+        if unknown:
+            raise ValueError('Job %d has unknown options %s' % (i, ', '.join(sorted(unknown))))
+        for key in BATCH_PATHS:
+            if job[key] is not None:
+                job[key] = os.path.join(base, job[key])
+        if job['name'] is None:
+            job['name'] = os.path.basename(job['input'])
+        jobs.append(job)
+    return jobs
+
+class _ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    '''
+    A connection pool which registers hstore once on each new connection
+    '''
+    def _connect(self, key=None):
+        conn = super(_ConnectionPool, self)._connect(key)
+        conn.set_session(readonly=False, autocommit=False)
+        psycopg2.extras.register_hstore(conn, unicode=True)
+        return conn
+
+def _overlap_groups(conn, wkts):
+    '''
+    Returns the indexes of wkts as a list of groups, with areas which overlap
+    in the same group. Areas which only touch are not grouped.
+    '''
+    parent = list(range(len(wkts)))
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    boxes = []
+    for wkt in wkts:
+        points = [point for ring in _wkt_rings(wkt) for point in ring]
+        boxes.append((min(x for (x, y) in points), min(y for (x, y) in points),
+                      max(x for (x, y) in points), max(y for (x, y) in points)))
+    curs = None
+    try:
+        curs = conn.cursor()
+        for i in range(len(wkts)):
+            for j in range(i):
+                (a, b) = (boxes[i], boxes[j])
+                if find(i) == find(j) or a[0] > b[2] or b[0] > a[2] or a[1] > b[3] or b[1] > a[3]:
+                    continue
+                if wkts[i] != wkts[j]:
+                    curs.execute('''SELECT ST_Area(ST_Intersection(ST_GeomFromText(%s, 4326),
+                                      ST_GeomFromText(%s, 4326))) > 0;''', (wkts[i], wkts[j]))
+                    if not curs.fetchone()[0]:
+                        continue
+                parent[find(i)] = find(j)
+    finally:
+        if curs is not None:
+            curs.close()
+        conn.rollback()
+
+    groups = {}
+    for i in range(len(wkts)):
+        groups.setdefault(find(i), []).append(i)
+    return sorted(groups.values())
+
+def _union_wkt(conn, wkts):
+    curs = None
+    try:
+        curs = conn.cursor()
+        curs.execute('''SELECT ST_AsText(ST_Union(ST_GeomFromText(wkt, 4326)))
+                          FROM unnest(%s) AS wkt;''', (sorted(set(wkts)),))
+        return curs.fetchone()[0]
+    finally:
+        if curs is not None:
+            curs.close()
+        conn.rollback()
+
+def _run_batch_job(job, wkt, cache_wkt, pool, connect_args, cache_keys):
+    '''
+    Runs one batch job on a pooled connection, returning its summary. The key
+    of the shared cached area it used, if any, is added to cache_keys.
+    '''
+    metrics = Metrics()
+    summary = {'name': job['name'], 'input': job['input']}
+    job = dict(job, backend='postgis')
+    conn = None
+    try:
+        conn = pool.getconn()
+        def create_source(strippable, suffixes, connected):
+            existing = OSMSource(wkt=wkt, strippable=strippable,
+                                 changes=job['osc'] is not None, buffer=job['buffer'],
+                                 load_method=job['load_method'],
+                                 cache=cache_wkt is not None, cache_wkt=cache_wkt,
+                                 suffixes=suffixes, distance_method=job['distance_method'],
+                                 # A shared local_all is built for every matcher so all jobs can use it
+                                 matchers=None if cache_wkt is not None else
+                                     ['duplicates'] + [matcher for matcher in ('nocity', 'building')
+                                                       if job[matcher] is not None],
+                                 unlogged=job['unlogged'], settings=job['settings'],
+                                 conn=conn, connected=connected, **connect_args)
+            if cache_wkt is not None:
+                cache_keys.add(existing._cache_key())
+            return existing
+        summary.update(conflate(job, wkt, create_source, metrics), status='ok')
+    except Exception as e:
+        l.error('Job %s failed: %s', job['name'], e)
+        summary.update(status='failed', error=str(e))
+    finally:
+        if conn is not None:
+            # The source resets the session when it is closed. A connection it
+            # failed to reset, or which was lost, is not reused.
+            reusable = (not conn.closed and conn.get_transaction_status()
+                        == psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+            if not reusable:
+                l.debug('Discarding connection')
+            pool.putconn(conn, close=not reusable)
+    summary['seconds'] = metrics.report()['seconds']
+    summary['stages'] = metrics.stages
+    return summary
+
+def run_batch(jobs, connect_args, concurrency=4, keep_cache=False):
+    '''
+    Runs batch jobs in concurrency threads sharing a pool of connections.
+    Jobs with overlapping areas share a cached local_all covering all of their
+    areas, which is evicted at the end unless keep_cache is set. Returns a
+    summary of the outcome and timings of each job.
+    '''
+    start = time.time()
+    pool = _ConnectionPool(1, concurrency, **connect_args)
+    try:
+        wkts = []
+        for job in jobs:
+            with open(job['wkt']) as f:
+                wkts.append(f.read())
+        cache_wkts = [None] * len(jobs)
+        conn = pool.getconn()
+        try:
+            groups = _overlap_groups(conn, wkts)
+            for group in groups:
+                if len(group) > 1:
+                    area = _union_wkt(conn, [wkts[i] for i in group])
+                    for i in group:
+                        cache_wkts[i] = area
+        finally:
+            pool.putconn(conn)
+        l.info('Running %d jobs over %d areas with %d connections', len(jobs), len(groups), concurrency)
+
+        tasks = queue.Queue()
+        for i in range(len(jobs)):
+            tasks.put(i)
+        results = [None] * len(jobs)
+        cache_keys = set()
+        def worker():
+            while True:
+                try:
+                    i = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                results[i] = _run_batch_job(jobs[i], wkts[i], cache_wkts[i], pool, connect_args,
+                                            cache_keys)
+        threads = [threading.Thread(target=worker, name='batch-%d' % n)
+                   for n in range(min(concurrency, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if cache_keys and not keep_cache:
+            l.debug('Evicting %d areas shared by batch jobs', len(cache_keys))
+            conn = pool.getconn()
+            try:
+                for key in sorted(cache_keys):
+                    evict_cached_areas(conn, key)
+            finally:
+                pool.putconn(conn)
+    finally:
+        pool.closeall()
+    return {'seconds': time.time() - start,
+            'ok': sum(1 for result in results if result['status'] == 'ok'),
+            'failed': sum(1 for result in results if result['status'] != 'ok'),
+            'jobs': results}
 
 if __name__ == '__main__':
     import argparse
@@ -490,49 +2940,134 @@ if __name__ == '__main__':
     verbosity.add_argument("-q", "--quiet", action="store_true")
 
     database_group = parser.add_argument_group('Database options', 'Options that effect the database connection')
+    database_group.add_argument('--backend', choices=['postgis', 'memory'], default='postgis', help='Match against a pgsnapshot database or an OSM extract held in memory. Defaults to postgis.')
     database_group.add_argument('-d', '--dbname', default='osm', help='Database to connect to. Defaults to osm.')
     database_group.add_argument('-U', '--username', default='osm', help='Username for database. Defaults to osm.')
     database_group.add_argument('--host', default='localhost', help='Hostname for database. Defaults to localhost.')
     database_group.add_argument('-p', '--port', default=5432, type=int, help='Port for database. Defaults to 5432.')
     database_group.add_argument('-P', '--password', default='osm',  help='Password for database. Defaults to osm.')
+    database_group.add_argument('--load-method', choices=['copy', 'insert'], default='copy', help='Method used to load import addresses. Defaults to copy.')
+    database_group.add_argument('--copy-batch', type=int, default=10000, help='Number of addresses sent per COPY. Defaults to 10000.')
+    database_group.add_argument('--itersize', type=int, default=2000, help='Number of changed objects fetched per round trip when writing the OSC file. Defaults to 2000.')
+    database_group.add_argument('--unlogged', action='store_true', help='Use unlogged tables in a schema for the run instead of temporary tables, so queries can use parallel workers. The schema is dropped when the run ends, or by a later run if it crashes.')
+    database_group.add_argument('--work-mem', default=None, help='work_mem for the session, such as 256MB. Defaults to the server setting.')
+    database_group.add_argument('--maintenance-work-mem', default=None, help='maintenance_work_mem for the session, used when building indexes. Defaults to the server setting.')
+    database_group.add_argument('--parallel-workers', type=int, default=None, help='max_parallel_workers_per_gather for the session. Defaults to the server setting.')
+    database_group.add_argument('--jit', choices=['on', 'off'], default=None, help='Whether the session uses JIT compilation of queries. Defaults to the server setting.')
 
     file_group = parser.add_argument_group('File options', 'Options that effect the input and output files')
-    file_group.add_argument('input', help='Input OSM file')
-    file_group.add_argument('output', type=argparse.FileType('w'), help='Output OSM file')
-    file_group.add_argument('--osc', type=argparse.FileType('w'), default=None, help='Output OSC file')
-    file_group.add_argument('-w', '--wkt', type=argparse.FileType('r'), help='Well-known text (WKT) file with a POLYGON or other area type to search for addresses in', required=True)
-    file_group.add_argument('-r', '--remove-tags', type=argparse.FileType('r'), default=None, help='File with list of tags to remove from any modified objects')
+    file_group.add_argument('input', nargs='?', help='Input OSM file. .osm, .osm.bz2, .osm.gz and .osm.pbf are supported')
+    file_group.add_argument('output', nargs='?', help='Output OSM file. .gz and .bz2 files are compressed and .osm.pbf files are written with osmium')
+    file_group.add_argument('--osc', default=None, help='Output OSC file. .gz and .bz2 files are compressed')
+    file_group.add_argument('-w', '--wkt', type=argparse.FileType('r'), help='Well-known text (WKT) file with a POLYGON or other area type to search for addresses in')
+    file_group.add_argument('-e', '--extract', default=None, help='OSM extract covering the WKT area, used with --backend memory')
+    file_group.add_argument('--ambiguous', default=None, help='Output file listing the import id, object type and object id of each ambiguous --nocity match')
+    file_group.add_argument('-r', '--remove-tags', default=None, help='File with list of tags to remove from any modified objects')
 
     matching_group = parser.add_argument_group('Matching options', 'Options that effect the .osc results. Output OSC file required')
     matching_group.add_argument('--nocity', type=float, default=None, help='Distance to detect matches without a city')
     matching_group.add_argument('--building', type=float, default=None, help='Distance to search around buildings for existing OSM addresses')
+    matching_group.add_argument('--street-suffixes', default=None, help='File of street suffixes and their abbreviations, one pair per line, applied to addr:street before comparing addresses')
+    matching_group.add_argument('--distance-method', choices=['buffer', 'dwithin', 'projected'], default='buffer', help='How distances are tested when generating changes. buffer intersects geography buffers, dwithin uses ST_DWithin with a bounding box pre-filter and projected uses geometries projected to the UTM zone of the WKT. Defaults to buffer.')
+    matching_group.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes and database connections used for matching, splitting the area into tiles. Defaults to 1.')
+
+    cache_group = parser.add_argument_group('Cache options', 'Options for keeping the OSM data of an area between runs')
+    cache_group.add_argument('--cache', action='store_true', help='Keep the OSM data for the WKT area in a persistent table and reuse it while the database is unchanged. With --batch, keeps the tables shared by overlapping jobs.')
+    cache_group.add_argument('--cache-list', action='store_true', help='List cached areas and exit')
+    cache_group.add_argument('--cache-evict', metavar='KEY', help='Drop cached areas with keys starting with KEY, or all for every area, and exit')
+
+    batch_group = parser.add_argument_group('Batch options', 'Options for running many jobs in one process')
+    batch_group.add_argument('--batch', metavar='MANIFEST', type=argparse.FileType('r'), default=None, help='Run the jobs in a JSON manifest instead of a single input, then exit')
+    batch_group.add_argument('--batch-jobs', type=int, default=4, help='Number of batch jobs run at once, each with its own database connection. Defaults to 4.')
+    batch_group.add_argument('--summary', type=argparse.FileType('w'), default=sys.stdout, help='File to write the JSON summary of batch jobs to. Defaults to stdout.')
 
     other_group = parser.add_argument_group('Other options')
+    other_group.add_argument('--incremental', metavar='STATE', default=None, help='State file recording the outcome of each address. Addresses unchanged since the run that wrote it reuse their previous outcome instead of being matched again.')
+    other_group.add_argument('--stream', action='store_true', help='Stream the input into the database instead of holding it in memory. The input is read twice.')
+    other_group.add_argument('--parser-workers', type=int, default=None, help='Number of processes used to parse .pbf input. Defaults to the number of cores.')
+    other_group.add_argument('--metrics', type=argparse.FileType('w'), default=None, help='Write the time and rows of each stage and SQL statement to this file as JSON')
+    other_group.add_argument('--explain', action='store_true', help='Include the EXPLAIN (ANALYZE, BUFFERS) plan of each query in --metrics. Queries are run twice.')
     other_group = other_group.add_argument('--buffer', type=float, default=0.5, help='Buffer distance in meters around existing addresses')
 
     args = parser.parse_args()
 
+    if args.cache_list or args.cache_evict:
+        conn = psycopg2.connect(database=args.dbname, user=args.username,
+                                password=args.password, host=args.host,
+                                port=str(args.port))
+        if args.cache_list:
+            for (key, wkt, state, created, used, size) in list_cached_areas(conn):
+                sys.stdout.write('%s  %s  used %s  %s bytes  %s\n'
+                                 % (key, created, used, size, ' '.join(wkt.split())[:60]))
+        else:
+            evicted = evict_cached_areas(conn, None if args.cache_evict == 'all' else args.cache_evict)
+            sys.stdout.write('Evicted %d cached areas\n' % evicted)
+        conn.close()
+        sys.exit(0)
+
+    if args.batch is not None:
+        summary = run_batch(read_manifest(args.batch),
+                            dict(database=args.dbname, user=args.username,
+                                 password=args.password, host=args.host,
+                                 port=str(args.port)),
+                            args.batch_jobs, keep_cache=args.cache)
+        json.dump(summary, args.summary, indent=2)
+        args.summary.write('\n')
+        sys.exit(1 if summary['failed'] else 0)
+
+    if args.input is None or args.output is None or args.wkt is None:
+        parser.error('input, output and --wkt are required')
+
     if args.osc is None:
-        if args.nocity is not None:
+        if args.nocity is not None or args.building is not None:
             raise argparse.ArgumentTypeError('--osc is required if diff generating options are used')
+    elif args.osc.endswith('.pbf'):
+        parser.error('--osc can not be written as PBF')
+
+    if args.backend == 'memory' and args.extract is None:
+        parser.error('--extract is required with --backend memory')
 
-    if args.remove_tags is None:
-        striplist = set(['created_by', 'odbl', 'odbl:note'])
-    else:
-        striplist = set(line.strip() for line in args.remove_tags.readlines()).union(set(['created_by', 'odbl', 'odbl:note']))
+    settings = dict((name, value) for (name, value) in
+                    (('work_mem', args.work_mem),
+                     ('maintenance_work_mem', args.maintenance_work_mem),
+                     ('max_parallel_workers_per_gather', args.parallel_workers),
+                     ('jit', args.jit)) if value is not None)
 
-    existing = OSMSource( database=args.dbname, user=args.username,
+    metrics = Metrics(explain=args.explain)
+    wkt = args.wkt.read()
+    def create_source(strippable, suffixes, connected):
+        if args.backend == 'memory':
+            return MemorySource(args.extract, wkt=wkt,
+                                strippable=strippable,
+                                changes=args.osc!=None,
+                                buffer=args.buffer,
+                                workers=args.parser_workers,
+                                suffixes=suffixes)
+        return OSMSource( database=args.dbname, user=args.username,
                           password=args.password, host=args.host,
                           port=str(args.port),
-                          wkt=args.wkt.read(),
-                          strippable=list(striplist),
+                          wkt=wkt,
+                          strippable=strippable,
                           changes=args.osc!=None,
-                          buffer=args.buffer)
-
+                          buffer=args.buffer,
+                          load_method=args.load_method,
+                          copy_batch=args.copy_batch,
+                          itersize=args.itersize,
+                          metrics=metrics if args.metrics else None,
+                          cache=args.cache,
+                          suffixes=suffixes,
+                          distance_method=args.distance_method,
+                          matchers=['duplicates'] + [matcher for matcher in ('nocity', 'building')
+                                                     if getattr(args, matcher) is not None],
+                          unlogged=args.unlogged,
+                          settings=settings,
+                          connected=connected)
 
-    source = ImportDocument(args.input)
+    # A single run is a job with the options given on the command line
+    job = dict((option, getattr(args, option, default)) for (option, default) in BATCH_DEFAULTS.items())
+    job.update(name=args.input, input=args.input, output=args.output, backend=args.backend,
+               settings=settings)
+    conflate(job, wkt, create_source, metrics)
 
-    source.remove_existing(existing)
-    source.remove_changed(existing, nocity=args.nocity, building=args.building)
-    source.output_osm(args.output)
-    source.output_osc(existing, args.osc)
+    if args.metrics is not None:
+        metrics.write(args.metrics)
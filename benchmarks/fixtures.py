@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Synthetic pgsnapshot fixtures for benchmarking addressmerge.
+
+A fixture is a grid of lots along numbered streets. Each lot is given one of
+the outcomes the matchers look for, in controlled proportions:
+
+duplicate: an existing addressed node, and an identical import address
+nocity:    an existing node without addr:city, and an import address 1m away
+building:  an existing building without an address, and an import address
+           inside it. Some of these buildings are multipolygons
+new:       no existing data, and a new import address
+
+Every street is also a named way, and every building corner is a node, so
+the local_all tables have a realistic mix of objects.
+'''
+
+import io
+import math
+import random
+
+from addressmerge import _copy_escape, _hstore_quote, OSMWriter
+
+def _cos(degrees):
+    return math.cos(math.radians(degrees))
+
+def _hstore(tags):
+    return u', '.join(u'%s=>%s' % (_hstore_quote(k), _hstore_quote(v))
+                      for (k, v) in sorted(tags.items()))
+
+class Fixture(object):
+    '''
+    Generates the rows of a synthetic area and the matching import addresses
+    '''
+    def __init__(self, lots, seed=0, duplicate=0.3, nocity=0.1, building=0.3,
+                 multipolygon=0.2, origin=(-123.0, 49.2), lot_size=20.0):
+        self.lots = lots
+        self.fractions = {'duplicate': duplicate, 'nocity': nocity, 'building': building}
+        self.multipolygon = multipolygon
+        self.side = int(lots ** 0.5) + 1
+        self._rand = random.Random(seed)
+        self._origin = origin
+        self._dy = lot_size * 9e-6
+        self._dx = self._dy / _cos(origin[1])
+
+        self.nodes = []
+        self.ways = []
+        self.relations = []
+        self.members = []
+        self.imports = []
+        self.outcomes = {'duplicate': 0, 'nocity': 0, 'building': 0, 'new': 0}
+        self._next_node = 1
+        self._next_way = 1
+        self._next_relation = 1
+        self._generate()
+
+    @property
+    def wkt(self):
+        (x0, y0) = self._origin
+        x1 = x0 + self.side * self._dx
+        y1 = y0 + self.side * self._dy
+        return 'POLYGON((%r %r, %r %r, %r %r, %r %r, %r %r))' % (x0, y0, x1, y0, x1, y1,
+                                                             x0, y1, x0, y0)
+
+    def _node(self, tags, x, y):
+        id = self._next_node
+        self._next_node += 1
+        self.nodes.append((id, tags, x, y))
+        return id
+
+    def _way(self, tags, coords):
+        id = self._next_way
+        self._next_way += 1
+        refs = [self._node({}, x, y) for (x, y) in coords[:-1]]
+        if coords[0] == coords[-1]:
+            refs.append(refs[0])
+        else:
+            refs.append(self._node({}, *coords[-1]))
+        self.ways.append((id, tags, refs, coords))
+        return id
+
+    def _relation(self, tags, way_id):
+        id = self._next_relation
+        self._next_relation += 1
+        self.relations.append((id, tags))
+        self.members.append((id, way_id, 'W', u'outer', 0))
+        return id
+
+    def _outcome(self):
+        r = self._rand.random()
+        for name in ('duplicate', 'nocity', 'building'):
+            if r < self.fractions[name]:
+                return name
+            r -= self.fractions[name]
+        return 'new'
+
+    def _generate(self):
+        (x0, y0) = self._origin
+        for row in range(self.side):
+            street = u'Street %d' % (row + 1)
+            y = y0 + (row + 0.5) * self._dy
+            self._way({u'highway': u'residential', u'name': street},
+                      [(x0, y - 0.5 * self._dy), (x0 + self.side * self._dx, y - 0.5 * self._dy)])
+        lot = 0
+        for row in range(self.side):
+            for column in range(self.side):
+                if lot >= self.lots:
+                    return
+                lot += 1
+                self._lot(row, column)
+
+    def _lot(self, row, column):
+        x = self._origin[0] + (column + 0.5) * self._dx
+        y = self._origin[1] + (row + 0.5) * self._dy
+        address = {u'addr:housenumber': u'%d' % (2 * column + 1),
+                   u'addr:street': u'Street %d' % (row + 1),
+                   u'addr:city': u'Springfield'}
+        outcome = self._outcome()
+        self.outcomes[outcome] += 1
+        ix = x
+        if outcome == 'duplicate':
+            self._node(dict(address), x, y)
+        elif outcome == 'nocity':
+            tags = dict(address)
+            del tags[u'addr:city']
+            self._node(tags, x, y)
+            ix = x + 9e-6 / _cos(y)
+        elif outcome == 'building':
+            hx = 0.3 * self._dx
+            hy = 0.3 * self._dy
+            square = [(x - hx, y - hy), (x + hx, y - hy), (x + hx, y + hy),
+                      (x - hx, y + hy), (x - hx, y - hy)]
+            if self._rand.random() < self.multipolygon:
+                way_id = self._way({}, square)
+                self._relation({u'type': u'multipolygon', u'building': u'yes'}, way_id)
+            else:
+                self._way({u'building': u'yes'}, square)
+        self.imports.append((-len(self.imports) - 1, address, (ix, y)))
+
+    def load(self, conn):
+        '''
+        Creates a minimal pgsnapshot schema on conn and loads the fixture into
+        it, replacing any existing pgsnapshot tables
+        '''
+        curs = conn.cursor()
+        try:
+            curs.execute('''CREATE EXTENSION IF NOT EXISTS hstore;''')
+            curs.execute('''CREATE EXTENSION IF NOT EXISTS postgis;''')
+            curs.execute('''DROP TABLE IF EXISTS nodes, ways, relations, relation_members;''')
+            curs.execute('''CREATE TABLE nodes (id bigint NOT NULL, version int NOT NULL,
+                            user_id int NOT NULL, tstamp timestamp without time zone NOT NULL,
+                            changeset_id bigint NOT NULL, tags hstore, geom geometry);''')
+            curs.execute('''CREATE TABLE ways (id bigint NOT NULL, version int NOT NULL,
+                            user_id int NOT NULL, tstamp timestamp without time zone NOT NULL,
+                            changeset_id bigint NOT NULL, tags hstore, nodes bigint[],
+                            linestring geometry);''')
+            curs.execute('''CREATE TABLE relations (id bigint NOT NULL, version int NOT NULL,
+                            user_id int NOT NULL, tstamp timestamp without time zone NOT NULL,
+                            changeset_id bigint NOT NULL, tags hstore);''')
+            curs.execute('''CREATE TABLE relation_members (relation_id bigint NOT NULL,
+                            member_id bigint NOT NULL, member_type character(1) NOT NULL,
+                            member_role text NOT NULL, sequence_id int NOT NULL);''')
+
+            self._copy(curs, 'nodes', (u'%d\t1\t1\t2000-01-01\t1\t%s\tSRID=4326;POINT(%r %r)\n'
+                                       % (id, _copy_escape(_hstore(tags)), x, y)
+                                       for (id, tags, x, y) in self.nodes))
+            self._copy(curs, 'ways', (u'%d\t1\t1\t2000-01-01\t1\t%s\t{%s}\tSRID=4326;LINESTRING(%s)\n'
+                                      % (id, _copy_escape(_hstore(tags)),
+                                         u','.join(u'%d' % ref for ref in refs),
+                                         u','.join(u'%r %r' % coord for coord in coords))
+                                      for (id, tags, refs, coords) in self.ways))
+            self._copy(curs, 'relations', (u'%d\t1\t1\t2000-01-01\t1\t%s\n'
+                                           % (id, _copy_escape(_hstore(tags)))
+                                           for (id, tags) in self.relations))
+            self._copy(curs, 'relation_members', (u'%d\t%d\t%s\t%s\t%d\n' % member
+                                                  for member in self.members))
+
+            curs.execute('''ALTER TABLE nodes ADD PRIMARY KEY (id);''')
+            curs.execute('''ALTER TABLE ways ADD PRIMARY KEY (id);''')
+            curs.execute('''ALTER TABLE relations ADD PRIMARY KEY (id);''')
+            curs.execute('''ALTER TABLE relation_members ADD PRIMARY KEY (relation_id, sequence_id);''')
+            curs.execute('''CREATE INDEX idx_nodes_geom ON nodes USING gist (geom);''')
+            curs.execute('''CREATE INDEX idx_ways_linestring ON ways USING gist (linestring);''')
+            curs.execute('''CREATE INDEX idx_relation_members_member_id_and_type
+                            ON relation_members USING btree (member_id, member_type);''')
+            curs.execute('''ANALYZE;''')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            curs.close()
+
+    def _copy(self, curs, table, rows):
+        data = io.BytesIO(u''.join(rows).encode('utf-8'))
+        curs.copy_expert('''COPY %s FROM STDIN;''' % table, data)
+
+    def write_extract(self, f):
+        '''
+        Writes the fixture's OSM data to f as an .osm extract with versions
+        '''
+        writer = OSMWriter(f)
+        writer.write(u'<?xml version="1.0"?>\n<osm version="0.6" upload="false" generator="addressmerge-fixture">\n')
+        for (id, tags, x, y) in self.nodes:
+            writer.modify_node((id, 1, tags, x, y))
+        for (id, tags, refs, coords) in self.ways:
+            writer.modify_way((id, 1, tags, refs))
+        members = {}
+        for (relation, member, type, role, sequence) in self.members:
+            members.setdefault(relation, []).append((type, member, role))
+        for (id, tags) in self.relations:
+            writer.modify_relation((id, 1, tags, [m[0] for m in members[id]],
+                                    [m[1] for m in members[id]], [m[2] for m in members[id]]))
+        writer.write(u'</osm>\n')
+        writer.flush()
+
+    def write_import(self, f):
+        '''
+        Writes the import addresses to f as .osm XML
+        '''
+        writer = OSMWriter(f)
+        writer.write(u'<?xml version="1.0"?>\n<osm version="0.6" upload="false" generator="addressmerge-fixture">\n')
+        for (id, tags, (x, y)) in self.imports:
+            writer.node(id, tags, x, y)
+        writer.write(u'</osm>\n')
+        writer.flush()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmark of the memory used to hold parsed import addresses.
+
+The same synthetic addresses are held as the deque of (id, tags, (x, y))
+tuples ImportDocument used before, and in an AddressStore. The bytes
+allocated per address are measured with tracemalloc, so Python 3.4 or later
+is needed. Iterating the store is checked to give back the same addresses.
+'''
+
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from addressmerge import AddressStore
+from serialize import make_objects
+
+def parsed(nodes):
+    '''
+    Copies nodes as a parser would produce them, with new strings for every
+    tag instead of the ones shared by make_objects
+    '''
+    for (id, tags, (x, y)) in nodes:
+        yield (id, dict((''.join(k), ''.join(v)) for (k, v) in tags.items()), (x, y))
+
+def measure(container, nodes):
+    tracemalloc.start()
+    start = time.time()
+    try:
+        store = container()
+        store.extend(parsed(nodes))
+        seconds = time.time() - start
+        (size, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (store, size, seconds)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark memory used by parsed addresses')
+    parser.add_argument('-n', '--count', type=int, default=200000, help='Number of addresses. Defaults to 200000.')
+    args = parser.parse_args()
+
+    nodes = make_objects(args.count)[0]
+    (old, old_size, old_time) = measure(deque, nodes)
+    (new, new_size, new_time) = measure(AddressStore, nodes)
+
+    sys.stdout.write('tuples:       %.0f bytes/address, %.0f addresses/s\n'
+                     % (old_size / args.count, args.count / old_time))
+    sys.stdout.write('AddressStore: %.0f bytes/address, %.0f addresses/s\n'
+                     % (new_size / args.count, args.count / new_time))
+    sys.stdout.write('reduction:    %.1fx\n' % (float(old_size) / new_size))
+    if list(new) == list(old):
+        sys.stdout.write('contents:     identical\n')
+    else:
+        sys.stdout.write('contents:     DIFFERENT\n')
+        sys.exit(1)
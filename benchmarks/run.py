@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Times each stage of addressmerge against synthetic fixtures.
+
+For each scale a fixture is generated and loaded into the benchmark database,
+replacing its pgsnapshot tables, and the normal addressmerge pipeline is run
+over it. The memory backend is run over the same fixture written as an .osm
+extract. The time taken by each stage is written as JSON so that runs before
+and after a change can be compared.
+
+The benchmark database must be a scratch database with PostGIS and hstore
+available. Its nodes, ways, relations and relation_members tables are dropped.
+'''
+
+import datetime
+import io
+import json
+import logging as l
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import psycopg2
+
+from addressmerge import OSMSource, MemorySource, ImportDocument
+from fixtures import Fixture
+
+STRIPPABLE = ['created_by', 'odbl', 'odbl:note']
+
+def timed(stages, name, function):
+    '''
+    Wraps function to add the time spent in it to stages[name]
+    '''
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stages[name] = stages.get(name, 0.0) + time.time() - start
+    return wrapper
+
+def make_source(backend, fixture, extract, args):
+    if backend == 'memory':
+        return MemorySource(extract, fixture.wkt, STRIPPABLE, True, args.buffer)
+    return OSMSource(database=args.dbname, user=args.username,
+                     password=args.password, host=args.host, port=str(args.port),
+                     wkt=fixture.wkt, strippable=STRIPPABLE, changes=True,
+                     buffer=args.buffer, load_method=args.load_method,
+                     distance_method=args.distance_method)
+
+def run_backend(backend, fixture, input, extract, args):
+    '''
+    Runs the pipeline with one backend, returning the stage timings and the
+    results to compare between backends
+    '''
+    stages = {}
+    start = time.time()
+    existing = make_source(backend, fixture, extract, args)
+    stages['create_tables'] = time.time() - start
+    # ImportDocument loads addresses with add_addresses and index_addresses
+    for (name, stage) in (('add_addresses', 'load_addresses'), ('index_addresses', 'load_addresses'),
+                          ('find_duplicates', 'find_duplicates'), ('generate_changes', 'generate_changes')):
+        setattr(existing, name, timed(stages, stage, getattr(existing, name)))
+
+    start = time.time()
+    source = ImportDocument(input)
+    stages['parse'] = time.time() - start
+
+    source.remove_existing(existing)
+    source.remove_changed(existing, nocity=args.nocity, building=args.building, jobs=args.jobs)
+
+    output = io.BytesIO()
+    source.output_osm = timed(stages, 'output_osm', source.output_osm)
+    source.output_osm(output)
+    with open(os.devnull, 'wb') as f:
+        source.output_osc = timed(stages, 'output_osc', source.output_osc)
+        source.output_osc(existing, f)
+
+    results = (set(re.findall(br'<node visible="true" id="(-?[0-9]+)"', output.getvalue())),
+               dict((node[0], node) for node in existing.get_changed_nodes()),
+               dict((way[0], way) for way in existing.get_changed_ways()),
+               dict((relation[0], relation) for relation in existing.get_changed_relations()))
+    existing.close()
+    return (stages, results)
+
+def run(scale, args, directory):
+    fixture = Fixture(scale, seed=args.seed, duplicate=args.duplicate,
+                      nocity=args.nocity_fraction, building=args.building_fraction,
+                      multipolygon=args.multipolygon, lot_size=args.lot_size)
+    backends = ['postgis', 'memory'] if args.backend == 'both' else [args.backend]
+    if 'postgis' in backends:
+        l.info('Loading fixture with %d lots', scale)
+        conn = psycopg2.connect(database=args.dbname, user=args.username,
+                                password=args.password, host=args.host, port=str(args.port))
+        try:
+            fixture.load(conn)
+        finally:
+            conn.close()
+    input = os.path.join(directory, 'import_%d.osm' % scale)
+    with open(input, 'wb') as f:
+        fixture.write_import(f)
+    extract = os.path.join(directory, 'extract_%d.osm' % scale)
+    if 'memory' in backends:
+        with open(extract, 'wb') as f:
+            fixture.write_extract(f)
+
+    run = {'scale': scale,
+           'objects': {'nodes': len(fixture.nodes), 'ways': len(fixture.ways),
+                       'relations': len(fixture.relations), 'imports': len(fixture.imports)},
+           'outcomes': fixture.outcomes,
+           'backends': {}}
+    results = []
+    for backend in backends:
+        (stages, result) = run_backend(backend, fixture, input, extract, args)
+        run['backends'][backend] = {'stages': stages,
+                                    'total': sum(stages.values()),
+                                    'output': len(result[0]),
+                                    'changed': [len(changed) for changed in result[1:]]}
+        results.append(result)
+    if len(results) == 2:
+        run['match'] = results[0] == results[1]
+        if not run['match']:
+            l.warning('Backends produced different results at scale %d', scale)
+    return run
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark addressmerge stages on synthetic data')
+
+    database_group = parser.add_argument_group('Database options', 'Options that effect the database connection')
+    database_group.add_argument('-d', '--dbname', default='addressmerge_bench', help='Scratch database to use. Its pgsnapshot tables are replaced. Defaults to addressmerge_bench.')
+    database_group.add_argument('-U', '--username', default='osm', help='Username for database. Defaults to osm.')
+    database_group.add_argument('--host', default='localhost', help='Hostname for database. Defaults to localhost.')
+    database_group.add_argument('-p', '--port', default=5432, type=int, help='Port for database. Defaults to 5432.')
+    database_group.add_argument('-P', '--password', default='osm',  help='Password for database. Defaults to osm.')
+    database_group.add_argument('--backend', choices=['postgis', 'memory', 'both'], default='postgis', help='Backend to benchmark. both also checks that the backends give the same results. Defaults to postgis.')
+    database_group.add_argument('--load-method', choices=['copy', 'insert'], default='copy', help='Method used to load import addresses. Defaults to copy.')
+
+    fixture_group = parser.add_argument_group('Fixture options')
+    fixture_group.add_argument('-s', '--scales', default='1000,10000,100000', help='Comma separated numbers of lots to run at. Defaults to 1000,10000,100000.')
+    fixture_group.add_argument('--seed', type=int, default=0, help='Random seed. Defaults to 0.')
+    fixture_group.add_argument('--duplicate', type=float, default=0.3, help='Fraction of exact duplicate addresses. Defaults to 0.3.')
+    fixture_group.add_argument('--nocity-fraction', type=float, default=0.1, help='Fraction of addresses matching existing addresses without a city. Defaults to 0.1.')
+    fixture_group.add_argument('--building-fraction', type=float, default=0.3, help='Fraction of addresses inside buildings without an address. Defaults to 0.3.')
+    fixture_group.add_argument('--lot-size', type=float, default=20.0, help='Width of each lot in meters. Smaller lots give denser areas with more candidates per address. Defaults to 20.')
+    fixture_group.add_argument('--multipolygon', type=float, default=0.2, help='Fraction of those buildings that are multipolygons. Defaults to 0.2.')
+
+    matching_group = parser.add_argument_group('Matching options')
+    matching_group.add_argument('--nocity', type=float, default=5.0, help='Distance to detect matches without a city. Defaults to 5.')
+    matching_group.add_argument('--building', type=float, default=5.0, help='Distance to search around buildings for existing OSM addresses. Defaults to 5.')
+    matching_group.add_argument('--buffer', type=float, default=0.5, help='Buffer distance in meters around existing addresses. Defaults to 0.5.')
+    matching_group.add_argument('--distance-method', choices=['buffer', 'dwithin', 'projected'], default='buffer', help='How distances are tested when generating changes. Defaults to buffer.')
+    matching_group.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used for matching. Defaults to 1.')
+
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help='File to write JSON results to. Defaults to stdout.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='addressmerge-bench-')
+    try:
+        runs = [run(int(scale), args, directory) for scale in args.scales.split(',')]
+    finally:
+        shutil.rmtree(directory)
+
+    json.dump({'date': datetime.datetime.utcnow().isoformat(),
+               'options': dict((k, v) for (k, v) in vars(args).items() if k not in ('output', 'password')),
+               'runs': runs},
+              args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmark of OSMWriter against the lxml serialization it replaced.
+
+Both writers serialize the same synthetic nodes, ways and relations. The
+outputs are checked to be canonically equivalent and objects/second is
+reported for each.
+'''
+
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from lxml import etree
+
+from addressmerge import OSMWriter
+
+class LxmlWriter(object):
+    '''
+    The per-object lxml serialization used before OSMWriter
+    '''
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, text):
+        self._f.write(text.encode('ascii'))
+
+    def flush(self):
+        pass
+
+    def node(self, id, tags, x, y):
+        xmlnode = etree.Element('node', {'visible':'true', 'id':str(id), 'lon':str(x), 'lat':str(y)})
+        for (k,v) in tags.items():
+            tag = etree.Element('tag',  {'k':k, 'v':v})
+            xmlnode.append(tag)
+
+        self._f.write(etree.tostring(xmlnode, pretty_print=True))
+
+    def modify_node(self, node):
+        xmlnode = etree.Element('node', {'id':str(node[0]), 'version':str(node[1]),  'lon':str(node[3]), 'lat':str(node[4])})
+        for (k,v) in node[2].items():
+            tag = etree.Element('tag',  {'k':k, 'v':v})
+            xmlnode.append(tag)
+
+        self._f.write(etree.tostring(xmlnode, pretty_print=True))
+
+    def modify_way(self, way):
+        xmlway = etree.Element('way', {'id':str(way[0]), 'version':str(way[1])})
+        for ref in way[3]:
+            nd = etree.Element('nd', {'ref':str(ref)})
+            xmlway.append(nd)
+        for (k,v) in way[2].items():
+            tag = etree.Element('tag',  {'k':k, 'v':v})
+            xmlway.append(tag)
+
+        self._f.write(etree.tostring(xmlway, pretty_print=True))
+
+    def modify_relation(self, relation):
+        xmlrelation = etree.Element('relation', {'id':str(relation[0]), 'version':str(relation[1])})
+        typelookup = {'N':'node', 'W':'way', 'R':'relation'}
+        for i in range(0, len(relation[3])):
+            member = etree.Element('member', {'type':typelookup[str(relation[3][i])], 'ref':str(relation[4][i]), 'role':relation[5][i]})
+            xmlrelation.append(member)
+        for (k,v) in relation[2].items():
+            tag = etree.Element('tag',  {'k':k, 'v':v})
+            xmlrelation.append(tag)
+
+        self._f.write(etree.tostring(xmlrelation, pretty_print=True))
+
+STREETS = [u'Main Street', u'Rue de l\'Église', u'Oak & Ash Avenue', u'"Quoted" Road', u'Straße <Nord>']
+
+def make_objects(count, seed=0):
+    rand = random.Random(seed)
+    nodes = []
+    modified_nodes = []
+    ways = []
+    relations = []
+    for i in range(count):
+        tags = {u'addr:housenumber': u'%d' % rand.randint(1, 9999),
+                u'addr:street': rand.choice(STREETS),
+                u'addr:city': u'Springfield'}
+        x = rand.uniform(-123.5, -122.5)
+        y = rand.uniform(49.0, 49.5)
+        nodes.append((-i - 1, tags, (x, y)))
+        modified_nodes.append((i + 1, rand.randint(1, 5), tags, x, y))
+        ways.append((i + 1, rand.randint(1, 5), dict(tags, building=u'yes'),
+                     [rand.randint(1, 10**9) for _ in range(5)]))
+        relations.append((i + 1, rand.randint(1, 5), dict(tags, type=u'multipolygon'),
+                          ['W', 'W'], [rand.randint(1, 10**9), rand.randint(1, 10**9)],
+                          [u'outer', u'inner']))
+    return (nodes, modified_nodes, ways, relations)
+
+def serialize(writer_class, objects):
+    (nodes, modified_nodes, ways, relations) = objects
+    f = io.BytesIO()
+    writer = writer_class(f)
+    writer.write(u'<?xml version="1.0"?>\n<osmChange version="0.6" generator="addressmerge">\n<create>\n')
+    start = time.time()
+    for (id, tags, (x, y)) in nodes:
+        writer.node(id, tags, x, y)
+    writer.write(u'</create>\n<modify>\n')
+    for node in modified_nodes:
+        writer.modify_node(node)
+    for way in ways:
+        writer.modify_way(way)
+    for relation in relations:
+        writer.modify_relation(relation)
+    writer.write(u'</modify>\n</osmChange>\n')
+    writer.flush()
+    return (time.time() - start, f.getvalue())
+
+def canonical(document):
+    return etree.tostring(etree.fromstring(document), method='c14n')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark OSM XML serialization')
+    parser.add_argument('-n', '--count', type=int, default=20000, help='Number of objects of each type. Defaults to 20000.')
+    args = parser.parse_args()
+
+    objects = make_objects(args.count)
+    total = 4 * args.count
+    (old_time, old_output) = serialize(LxmlWriter, objects)
+    (new_time, new_output) = serialize(OSMWriter, objects)
+
+    sys.stdout.write('lxml:      %.0f objects/s\n' % (total / old_time))
+    sys.stdout.write('OSMWriter: %.0f objects/s\n' % (total / new_time))
+    sys.stdout.write('speedup:   %.1fx\n' % (old_time / new_time))
+    if new_output == old_output:
+        sys.stdout.write('output:    byte-identical\n')
+    elif canonical(new_output) == canonical(old_output):
+        sys.stdout.write('output:    canonically equivalent\n')
+    else:
+        sys.stdout.write('output:    DIFFERENT\n')
+        sys.exit(1)